@@ -0,0 +1,70 @@
+"""
+Per-call overhead of a fresh boto3 client, as lib.email, lib.data and
+lambda_handler used to build for every call, against the shared registry in
+lib.aws; both on their own and around a dynamodb get_item on moto. moto
+answers in process, so the https connections the pool keeps open are not
+part of these numbers
+
+    python benchmarks/aws_clients.py
+"""
+
+import os
+import sys
+import time
+
+import boto3
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from lib.aws import aws_client  # noqa: E402
+
+
+def per_call(fn, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    import moto
+
+    for name, value in {
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "AWS_ACCESS_KEY_ID": "testing",
+        "AWS_SECRET_ACCESS_KEY": "testing",
+    }.items():
+        os.environ[name] = value
+
+    with moto.mock_aws():
+        aws_client("dynamodb").create_table(
+            TableName="mail",
+            KeySchema=[{"AttributeName": "id", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "id", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        key = {"id": {"S": "missing@example.com"}}
+
+        for service in ("dynamodb", "sqs", "ssm"):
+            fresh = per_call(lambda: boto3.client(service), 50)
+            pooled = per_call(lambda: aws_client(service), 100_000)
+            print(
+                f"{service} client: boto3.client {fresh * 1000:.2f}ms, "
+                f"aws_client {pooled * 1e6:.2f}us"
+            )
+
+        fresh = per_call(
+            lambda: boto3.client("dynamodb").get_item(TableName="mail", Key=key), 50
+        )
+        pooled = per_call(
+            lambda: aws_client("dynamodb").get_item(TableName="mail", Key=key), 200
+        )
+        print(
+            f"get_item: boto3.client {fresh * 1000:.2f}ms, "
+            f"aws_client {pooled * 1000:.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Time the lib/headers parsers against the inline regexes they replaced, for a
+From header seen before (an interned contact), one seen for the first time,
+and a References header three ids deep
+
+    python benchmarks/headers.py
+"""
+
+import os
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from lib.headers import (  # noqa: E402
+    normalize_message_id,
+    normalize_references,
+    parse_contact,
+)
+
+
+def old_contact(header: str):
+    # what Contact.from_header did before lib/headers
+    match = re.search(r"^\"?(.*?)\"?\s*<?([^<>@\s]+@[^<>@\s]+\.[^<>@\s]+)>?$", header)
+    if match:
+        return match.group(1).strip(), match.group(2).strip()
+
+
+def old_references(header: str) -> list[str]:
+    return [re.sub(r"[\r\n]+$", "", ref) for ref in header.split(" ")]
+
+
+def old_message_id(header: str) -> str:
+    match = re.search(r"^<(.+)>", header)
+    if match:
+        return match.group(1).strip()
+
+
+def uncached_contact(header: str):
+    parse_contact.cache_clear()
+    return parse_contact(header)
+
+
+def per_call(fn, value: str, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(value)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    sender = '"Barrister James Okoro" <james.okoro@example.com>'
+    references = " ".join(f"<{n}.reply@mail.example.com>" for n in range(3))
+    message_id = "<0100018c.abcdef@email.amazonses.com>"
+
+    cases = [
+        ("From, repeated", sender, [old_contact, parse_contact]),
+        ("From, first seen", sender, [old_contact, uncached_contact]),
+        ("References", references, [old_references, normalize_references]),
+        ("Message-ID", message_id, [old_message_id, normalize_message_id]),
+    ]
+    for name, value, fns in cases:
+        timings = ", ".join(
+            f"{fn.__name__} {per_call(fn, value, 100_000) * 1e6:.2f}us" for fn in fns
+        )
+        print(f"{name}: {timings}")
+
+
+if __name__ == "__main__":
+    main()
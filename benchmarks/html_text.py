@@ -0,0 +1,69 @@
+"""
+Time html_to_text against the BeautifulSoup get_text() it replaced, on the
+corpus in tests/data/html and on a large CSS-heavy newsletter built from it
+
+    python benchmarks/html_text.py
+"""
+
+import glob
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from lib.html_text import html_to_text  # noqa: E402
+
+
+def soup_text(html: str) -> str:
+    from bs4 import BeautifulSoup
+
+    return BeautifulSoup(html, "html.parser").get_text().strip()
+
+
+def unbounded(html: str) -> str:
+    return html_to_text(html, max_chars=sys.maxsize)
+
+
+def per_call(fn, html: str, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(html)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    corpus = {}
+    for path in sorted(
+        glob.glob(os.path.join(ROOT, "tests", "data", "html", "*.html"))
+    ):
+        with open(path, encoding="utf-8") as file:
+            corpus[os.path.basename(path)] = file.read()
+
+    # newsletters inline a lot of css ahead of comparatively little text
+    with open(os.path.join(ROOT, "tests", "data", "html", "newsletter.html")) as file:
+        newsletter = file.read()
+    style = "<style>" + ".c{margin:0;padding:0;color:#333}\n" * 2000 + "</style>"
+    corpus["large newsletter"] = (style + newsletter) * 8
+    # and long quoted threads are mostly text, which is where the bound helps
+    corpus["long thread"] = corpus["inheritance.html"] * 500
+
+    fns = [html_to_text, unbounded]
+    try:
+        import bs4  # noqa: F401
+
+        fns.append(soup_text)
+    except ImportError:
+        print("bs4 not installed, skipping the BeautifulSoup comparison")
+
+    for name, html in corpus.items():
+        repeat = 20 if len(html) > 100_000 else 500
+        timings = ", ".join(
+            f"{fn.__name__} {per_call(fn, html, repeat) * 1000:.2f}ms" for fn in fns
+        )
+        print(f"{name} ({len(html) // 1024}KB): {timings}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Time receive_handler's ingest step, SES content to a parsed Email, against the
+base64 round trip and utf-8 decode and full-message parse it replaced, on the
+sample SES event and on one carrying a large attachment
+
+    python benchmarks/ingest.py
+"""
+
+import base64
+import email
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from lambda_handler import ses_content_bytes  # noqa: E402
+from lib.email import Email  # noqa: E402
+
+
+def is_base64(s) -> bool:
+    # what receive_handler checked before ses_content_bytes
+    try:
+        return base64.b64encode(base64.b64decode(s)).decode() == s
+    except Exception:
+        return False
+
+
+def old_ingest(ses_message: dict):
+    content = ses_message["content"]
+    decoded = (base64.b64decode(content) if is_base64(content) else content).decode(
+        "utf-8"
+    )
+    message = email.message_from_string(decoded)
+    return message["From"], message["To"], message["Subject"]
+
+
+def new_ingest(ses_message: dict):
+    parsed = Email.from_bytes(ses_content_bytes(ses_message))
+    return parsed.sender, parsed.recipient, parsed.subject
+
+
+def per_call(fn, ses_message: dict, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(ses_message)
+    return (time.perf_counter() - start) / repeat
+
+
+def with_attachment(ses_message: dict, size: int) -> dict:
+    raw = ses_content_bytes(ses_message)
+    head, _, body = raw.partition(b"\r\n\r\n")
+    attachment = base64.encodebytes(os.urandom(size))
+    raw = (
+        head.replace(b"Content-Type:", b"X-Old-Content-Type:")
+        + b"\r\nContent-Type: multipart/mixed; boundary=b\r\n\r\n"
+        + b"--b\r\nContent-Type: text/plain\r\n\r\n"
+        + body
+        + b"\r\n--b\r\nContent-Type: application/pdf\r\n"
+        + b"Content-Disposition: attachment; filename=invoice.pdf\r\n"
+        + b"Content-Transfer-Encoding: base64\r\n\r\n"
+        + attachment
+        + b"--b--\r\n"
+    )
+    return dict(ses_message, content=base64.b64encode(raw).decode("ascii"))
+
+
+def main():
+    with open(os.path.join(ROOT, "src", "test_receive_event.json")) as file:
+        sample = json.load(file)
+
+    events = {
+        "sample event": sample,
+        "1MB attachment": with_attachment(sample, 1024 * 1024),
+    }
+    for name, ses_message in events.items():
+        repeat = 20 if len(ses_message["content"]) > 100_000 else 500
+        timings = ", ".join(
+            f"{fn.__name__} {per_call(fn, ses_message, repeat) * 1000:.2f}ms"
+            for fn in (old_ingest, new_ingest)
+        )
+        print(f"{name} ({len(ses_message['content']) // 1024}KB): {timings}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Batch latency and redundant sends for send_handler against the serial handler
+it replaced, which gave up on the first error and had sqs redeliver the whole
+batch; runs on moto with a fake smtp send and injected failures
+
+    python benchmarks/send_handler.py
+"""
+
+import os
+import sys
+import time
+from collections import Counter
+from email.utils import parseaddr
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.insert(0, os.path.join(ROOT, "tests"))
+
+from conftest import create_tables  # noqa: E402
+
+BATCH = 10
+SEND_SECONDS = 0.2
+# recipients whose first send fails
+FAILING = {3, 7}
+
+
+def old_send_handler(event, context):
+    # what send_handler did before partial batch failures, on the same send_email
+    import lambda_handler
+
+    for record in event["Records"]:
+        this_email, envelope = lambda_handler.decode_envelope(record["body"])
+        if envelope.get("send_after", 0) == 0:
+            if not lambda_handler.send_email(this_email):
+                return {"statusCode": 500}
+            this_email.sent = True
+            this_email.write()
+    return {"statusCode": 200}
+
+
+def replies() -> list[dict]:
+    from lib.email import ClientReplyMessage, Email
+    from lib.headers import Contact
+
+    records = []
+    for n in range(BATCH):
+        email = Email(
+            Contact("Frank", "frank56furter@gmail.com"),
+            Contact("Scammer", f"scammer{n}@example.com"),
+            "RE: hello",
+            body=f"reply {n}",
+        )
+        body = ClientReplyMessage(email=email).as_json()
+        records.append({"messageId": f"r{n}", "body": body})
+    return records
+
+
+def run(handler) -> tuple[float, int, int]:
+    # delivers the batch until nothing is left to retry, the way sqs would
+    import lambda_handler
+
+    sends = Counter()
+
+    def send(sender, password, message):
+        recipient = parseaddr(message["To"])[1]
+        time.sleep(SEND_SECONDS)
+        sends[recipient] += 1
+        n = int(recipient.removeprefix("scammer").partition("@")[0])
+        if n in FAILING and sends[recipient] == 1:
+            raise ConnectionError("smtp unavailable")
+
+    lambda_handler.smtp_pool.send = send
+
+    records = replies()
+    deliveries = 0
+    first_batch = None
+    while records:
+        start = time.perf_counter()
+        response = handler({"Records": records}, None)
+        deliveries += 1
+        if first_batch is None:
+            first_batch = time.perf_counter() - start
+
+        if response["statusCode"] != 200:
+            continue
+        failed = {f["itemIdentifier"] for f in response.get("batchItemFailures", [])}
+        records = [record for record in records if record["messageId"] in failed]
+
+    redundant = sum(count - 1 for count in sends.values()) - len(FAILING)
+    return first_batch, deliveries, redundant
+
+
+def main():
+    import moto
+
+    for name, value in {
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "AWS_ACCESS_KEY_ID": "testing",
+        "AWS_SECRET_ACCESS_KEY": "testing",
+        "MAIL_TABLE": "mail",
+    }.items():
+        os.environ[name] = value
+
+    import lambda_handler
+
+    for handler in (old_send_handler, lambda_handler.send_handler):
+        with moto.mock_aws():
+            from lib import aws, params
+
+            aws.session_cache = None
+            aws.client_cache.clear()
+            aws.resource_cache.clear()
+            params.invalidate_parameters()
+
+            create_tables(aws.aws_client("dynamodb"))
+            aws.aws_client("ssm").put_parameter(
+                Name="/bogamail/passwords/frank56furter",
+                Value="password",
+                Type="SecureString",
+            )
+
+            first_batch, deliveries, redundant = run(handler)
+            print(
+                f"{handler.__name__}: first batch {first_batch:.2f}s, "
+                f"{deliveries} deliveries, {redundant} redundant sends"
+            )
+
+
+if __name__ == "__main__":
+    main()
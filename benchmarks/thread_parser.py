@@ -0,0 +1,57 @@
+"""
+Accuracy of strip_quoted on the hand-labelled bodies in tests/data/threads.json,
+against the ">" line filter it replaced, and how long it takes per email
+
+    python benchmarks/thread_parser.py
+"""
+
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from lib.thread_parser import strip_quoted  # noqa: E402
+
+
+def clean_email(message: str) -> str:
+    # what the reply worker used before strip_quoted
+    email = ""
+    for line in message.splitlines():
+        if not line.strip().startswith(">"):
+            email += line.strip()
+    return email
+
+
+def per_call(fn, body: str, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(body)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    with open(os.path.join(ROOT, "tests", "data", "threads.json")) as file:
+        samples = json.load(file)
+
+    for fn in (strip_quoted, clean_email):
+        correct = sum(fn(s["body"]) == s["expected"] for s in samples)
+        print(f"{fn.__name__}: {correct}/{len(samples)} correct")
+
+    for sample in samples:
+        if strip_quoted(sample["body"]) != sample["expected"]:
+            print(f"  missed {sample['name']}: {strip_quoted(sample['body'])!r}")
+
+    typical = sum(per_call(strip_quoted, s["body"], 1000) for s in samples)
+    print(f"typical email: {typical / len(samples) * 1e6:.1f}us")
+
+    large = ("Some text about investing\n" * 200 + "> quoted line\n" * 200) * 10
+    for fn in (strip_quoted, clean_email):
+        seconds = per_call(fn, large, 20)
+        print(f"{fn.__name__} on {len(large) // 1024}KB: {seconds * 1000:.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
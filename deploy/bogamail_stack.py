@@ -14,6 +14,7 @@ from aws_cdk import aws_ssm as ssm
 from aws_cdk.aws_secretsmanager import Secret
 from aws_cdk import aws_events as events
 from aws_cdk import aws_events_targets as targets
+from aws_cdk import aws_s3 as s3
 
 
 class BogamailStack(Stack):
@@ -55,6 +56,23 @@ class BogamailStack(Stack):
             billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
         )
 
+        dedup_table = dynamodb.Table(
+            self,
+            "DedupTable",
+            partition_key=dynamodb.Attribute(
+                name="id", type=dynamodb.AttributeType.STRING
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="expires",
+        )
+
+        blob_bucket = s3.Bucket(
+            self,
+            "BlobBucket",
+            block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
+            encryption=s3.BucketEncryption.S3_MANAGED,
+        )
+
         mail_table.add_global_secondary_index(
             partition_key=dynamodb.Attribute(
                 name="sender", type=dynamodb.AttributeType.STRING
@@ -73,6 +91,15 @@ class BogamailStack(Stack):
             projection_type=dynamodb.ProjectionType.ALL,
         )
 
+        mail_table.add_global_secondary_index(
+            partition_key=dynamodb.Attribute(
+                name="conversation", type=dynamodb.AttributeType.STRING
+            ),
+            sort_key=dynamodb.Attribute(name="ts", type=dynamodb.AttributeType.NUMBER),
+            index_name="ConversationIndex",
+            projection_type=dynamodb.ProjectionType.ALL,
+        )
+
         mail_table.add_global_secondary_index(
             partition_key=dynamodb.Attribute(
                 name="sent", type=dynamodb.AttributeType.STRING
@@ -102,6 +129,8 @@ class BogamailStack(Stack):
             runtime=lambda_.Runtime.PYTHON_3_12,
             environment={
                 "MAIL_TABLE": mail_table.table_name,
+                "BLOB_BUCKET": blob_bucket.bucket_name,
+                "DEDUP_TABLE": dedup_table.table_name,
                 "RECEIVE_QUEUE_URL": receive_queue.queue_url,
                 "CLIENT_QUEUE_URL": client_queue.queue_url,
             },
@@ -117,6 +146,7 @@ class BogamailStack(Stack):
             runtime=lambda_.Runtime.PYTHON_3_12,
             environment={
                 "MAIL_TABLE": mail_table.table_name,
+                "BLOB_BUCKET": blob_bucket.bucket_name,
                 "SEND_QUEUE_URL": client_queue.queue_url,
             },
         )
@@ -131,6 +161,7 @@ class BogamailStack(Stack):
             runtime=lambda_.Runtime.PYTHON_3_12,
             environment={
                 "MAIL_TABLE": mail_table.table_name,
+                "BLOB_BUCKET": blob_bucket.bucket_name,
             },
         )
 
@@ -166,6 +197,13 @@ class BogamailStack(Stack):
             string_value=data_table.table_name,
         )
 
+        blob_bucket_parameter = ssm.StringParameter(
+            self,
+            "BlobBucketSsmParameter",
+            parameter_name="/bogamail/blob_bucket",
+            string_value=blob_bucket.bucket_name,
+        )
+
         client_queue_parameter = ssm.StringParameter(
             self,
             "ClientQueueSsmParameter",
@@ -184,12 +222,20 @@ class BogamailStack(Stack):
         client_queue_parameter.grant_read(receive_function)
         send_queue_parameter.grant_read(send_function)
         mail_table.grant_write_data(receive_function)
+        dedup_table.grant_read_write_data(receive_function)
         client_queue.grant_send_messages(receive_function)
         receipt_rule.add_action(ses_actions.Sns(topic=receive_topic))
-        receive_function.add_event_source(SqsEventSource(receive_queue))
-        send_function.add_event_source(SqsEventSource(send_queue))
+        receive_function.add_event_source(
+            SqsEventSource(receive_queue, report_batch_item_failures=True)
+        )
+        send_function.add_event_source(
+            SqsEventSource(send_queue, batch_size=10, report_batch_item_failures=True)
+        )
         mail_table.grant_read_write_data(send_function)
         mail_table.grant_read_write_data(schedule_function)
+        blob_bucket.grant_read_write(receive_function)
+        blob_bucket.grant_read_write(send_function)
+        blob_bucket.grant_read(schedule_function)
 
         password_parameter_policy_statement = iam.PolicyStatement(
             actions=["ssm:GetParameter"],
@@ -198,7 +244,19 @@ class BogamailStack(Stack):
             ],
         )
 
+        # lib.params prefetches everything under /bogamail in one call
+        parameter_prefetch_policy_statement = iam.PolicyStatement(
+            actions=["ssm:GetParametersByPath"],
+            resources=[
+                f"arn:aws:ssm:{self.region}:{self.account}:parameter/bogamail",
+                f"arn:aws:ssm:{self.region}:{self.account}:parameter/bogamail/*",
+            ],
+        )
+
         send_function.add_to_role_policy(password_parameter_policy_statement)
+        send_function.add_to_role_policy(parameter_prefetch_policy_statement)
+        schedule_function.add_to_role_policy(password_parameter_policy_statement)
+        schedule_function.add_to_role_policy(parameter_prefetch_policy_statement)
 
         bogamail_policy_document = iam.PolicyDocument(
             statements=[
@@ -235,12 +293,20 @@ class BogamailStack(Stack):
                 iam.PolicyStatement(
                     actions=["sns:Publish"], resources=[receive_topic.topic_arn]
                 ),
+                iam.PolicyStatement(
+                    actions=["s3:GetObject", "s3:PutObject"],
+                    resources=[blob_bucket.arn_for_objects("*")],
+                ),
+                iam.PolicyStatement(
+                    actions=["s3:ListBucket"], resources=[blob_bucket.bucket_arn]
+                ),
                 iam.PolicyStatement(
                     actions=["ssm:GetParameter"],
                     resources=[
                         f"arn:aws:ssm:{self.region}:{self.account}:parameter/bogamail/*"
                     ],
                 ),
+                parameter_prefetch_policy_statement,
             ]
         )
 
@@ -0,0 +1,6 @@
+from lib.email import backfill_conversation_ids
+
+# fills in the conversation attribute (ConversationIndex key) on mail items
+# written before it existed or before it was scoped to the persona; safe to
+# re-run
+print(f"updated {backfill_conversation_ids()} items")
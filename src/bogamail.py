@@ -1,66 +1,135 @@
+import asyncio
+import logging
 import time
 import yaml
-from lib.email import Email, wait_for_email
-from lib.llm_wrapper import LLMInterface
+from lib.data import get_summary, store_summary
+from lib.email import Email, poll_for_email
+from lib.llm_wrapper import ModelConfig
+from lib.model_pool import ModelPool
+from lib.pipeline import ReplyPipeline
+from lib.reply_cache import ReplyCache
+from lib.thread_cache import ThreadCache
+from lib.thread_parser import strip_quoted, thread_turns
 
 # load the config
 with open('./src/config.yaml', 'r') as file:
     config = yaml.safe_load(file)
 
-llm = LLMInterface(root_prompt=config['system']['prompt'])
-
-def clean_email(message:str) -> str:
-    '''
-    Remove all the threads ">" from a string
-    :param message: string
-    :return: string
-    '''
-    email = ""
-    for line in message.splitlines():
-        if not line.strip().startswith(">"):
-            email += line.strip()
-
-    return email
-
-
-def main():
-    while True:
-        emails = wait_for_email()
-        for this_email in emails:
-            generate_reply_to(this_email).enqueue_for_send()
-
-        # rate limiter
-        time.sleep(1)
-
+threads = ThreadCache()
+models = None
+replies = None
+
+# turns kept word for word, once there are more than SUMMARIZE_AFTER of them
+# the older ones are folded into the summary in one go
+RECENT_TURNS = 6
+SUMMARIZE_AFTER = 12
+
+
+async def main():
+    global models, replies
+    logging.basicConfig(level=logging.INFO)
+
+    replies = ReplyCache(**config.get('reply_cache', {}))
+
+    # each worker is its own process, they share the mmap'd weights
+    workers = config['system'].get('model_workers', 1)
+    models = ModelPool(root_prompt=config['system']['prompt'],
+                       model=ModelConfig.from_dict(config.get('model')),
+                       workers=workers,
+                       context_budget=config['system'].get('context_budget'))
+
+    # polling, thread loads and sending happen while the model is generating,
+    # so the model is never left waiting on sqs or dynamodb
+    pipeline = ReplyPipeline(
+        poll=poll_for_email,
+        load=load_thread,
+        generate=generate_response,
+        send=send_reply,
+        generators=workers,
+    )
+    try:
+        await pipeline.run()
+    finally:
+        models.close()
+        logging.info(f"reply cache: {replies.stats()}")
 
-def generate_reply_to(received_email: Email) -> Email:
-    email_thread = ""
-    for previous in received_email.thread():
-        email_thread += f"{previous.sender.name}: \n{previous.body}"
 
-    llm.parse_history(email_thread)
+def load_thread(received_email: Email) -> list[Email]:
+    return threads.thread(received_email)
 
-    subject = "RE: " + received_email.subject
 
-    # need to feed the history in...
+def generate_response(received_email: Email, thread: list[Email]) -> str:
     try:
         personality = config['accounts'][received_email.recipient.email]['personality']
     except KeyError:
         personality = ""
 
-    print(clean_email(received_email.body))
+    turns = thread_turns(thread, exclude=received_email.get_message_id())
+
+    # the same campaign email at the same point in a thread gets the same answer
+    cache_key = ReplyCache.key(received_email.body, personality, len(turns))
+    response = replies.get(cache_key)
+    if response is not None:
+        return response
 
-    llm.start_new_chat(user_prompt=personality)
-    response = llm.respond_to(clean_email(received_email.body))
+    summary, recent = summarize_thread(received_email, turns)
+
+    # earlier emails in the thread, our own replies as the assistant's turns
+    history = [
+        ('assistant' if turn.speaker.email == received_email.recipient.email else 'user', turn.text)
+        for turn in recent
+    ]
+    prompt = strip_quoted(received_email.body)
+    print(prompt)
+
+    start_clock = time.time()
+    response = models.respond(received_email.conversation_id(),
+                              prompt,
+                              personality=personality,
+                              history=history,
+                              summary=summary)
+    replies.put(cache_key, response, time.time() - start_clock)
 
     print("=" * 32)
     print(response)
 
-    return received_email.reply(
-        subject=subject,
+    return response
+
+
+def summarize_thread(received_email: Email, turns: list) -> tuple[str, list]:
+    '''
+    Fold turns that have dropped out of the recent window into the rolling
+    summary of this conversation, so the prompt stays the same size however
+    long the conversation gets
+    :return: the summary and the turns to include word for word
+    '''
+    scammer = received_email.sender.email
+    conversation_id = received_email.conversation_id()
+    summary, summarized_through = get_summary(scammer, conversation_id)
+
+    unsummarized = [turn for turn in turns if turn.ts > summarized_through]
+    if len(unsummarized) <= SUMMARIZE_AFTER:
+        return summary, unsummarized
+
+    older, recent = unsummarized[:-RECENT_TURNS], unsummarized[-RECENT_TURNS:]
+    summary = models.summarize(summary, [(turn.speaker.name or turn.speaker.email, turn.text)
+                                         for turn in older])
+    store_summary(scammer, conversation_id, summary, older[-1].ts)
+    print(f"summarized {len(older)} emails from {scammer}")
+
+    return summary, recent
+
+
+def send_reply(received_email: Email, response: str) -> Email:
+    reply = received_email.reply(
+        subject="RE: " + received_email.subject,
         body=response,
     )
+    threads.add(reply)
+    reply.enqueue_for_send()
 
+    return reply
 
 
-main()
+if __name__ == '__main__':
+    asyncio.run(main())
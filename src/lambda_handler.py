@@ -1,72 +1,231 @@
 import json
 import os
+import re
 import base64
-import boto3
-import smtplib
 import time
+from botocore.exceptions import ClientError
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
-from lib.email import Email, mail_table
+from typing import Iterator
+from lib.aws import aws_client
+from lib.dedup import (
+    claim_delivery,
+    complete_delivery,
+    peek_message_id,
+    release_delivery,
+)
+from lib.headers import Contact
+from lib.params import get_parameter
+from lib.smtp_pool import smtp_pool
+from lib.email import (
+    Email,
+    batch_backoff,
+    decode_envelope,
+    enqueue_emails_for_client,
+    mail_table,
+    write_emails,
+)
 
+# send queue records processed at once within one batch
+SEND_CONCURRENCY = 4
+# scheduled sends in flight at once, and how long before the lambda deadline
+# to stop picking up new ones
+DISPATCH_CONCURRENCY = 4
+DISPATCH_DEADLINE_MARGIN_MS = 30 * 1000
+# sent state while a scheduled email is claimed by a dispatcher run, and how
+# long the claim holds before another run may take the email over
+SENDING = "Sending"
+SEND_LEASE_SECONDS = 2 * 300
+# tries at marking a delivered email sent; a row left in Sending is taken over
+# once its lease runs out, and sent a second time
+MARK_SENT_ATTEMPTS = 5
 
-def is_base64(s):
-    try:
-        return base64.b64encode(base64.b64decode(s)).decode() == s
-    except Exception:
-        return False
+BASE64_LINE = re.compile(r"[A-Za-z0-9+/]+={0,2}")
 
 
-def get_emails_to_be_sent() -> list[Email]:
-    dynamodb_client = boto3.client("dynamodb")
-    current_timestamp = int(time.time())
+def is_base64(s) -> bool:
+    # an rfc822 message always opens with a "Name: value" header line and ":"
+    # is not in the base64 alphabet, so checking the start of the first line
+    # is enough; no need to decode the whole payload to find out
+    head = s[:1024].split("\n", 1)[0].rstrip("\r")
+    return BASE64_LINE.fullmatch(head) is not None
 
-    response = dynamodb_client.query(
+
+def ses_content_bytes(ses_message: dict) -> bytes:
+    content = ses_message["content"]
+    encoding = ses_message.get("receipt", {}).get("action", {}).get("encoding")
+
+    if encoding == "BASE64" or (encoding is None and is_base64(content)):
+        return base64.b64decode(content)
+    if isinstance(content, bytes):
+        return content
+    return content.encode("utf-8", "surrogateescape")
+
+
+def scheduled_queries(now: int) -> list[dict]:
+    # emails due to go out, and ones a dispatcher claimed but never finished
+    # (it crashed or timed out) whose lease has run out
+    base = dict(
         TableName=mail_table(),
         IndexName="SendIndex",
-        KeyConditionExpression="send_after >= :send_after AND sent = :sent",
-        ExpressionAttributeValues={
-            ":sent": {"S": str(False)},
-            ":send_after": {"N": str(current_timestamp)},
-        },
+        KeyConditionExpression="sent = :sent AND send_after <= :now",
     )
-
     return [
-        Email.from_message_string(item.get("message")["S"])
-        for item in response["Items"]
+        dict(
+            base,
+            ExpressionAttributeValues={
+                ":sent": {"S": str(False)},
+                ":now": {"N": str(now)},
+            },
+        ),
+        dict(
+            base,
+            FilterExpression="attribute_not_exists(sending_since) OR sending_since < :stale",
+            ExpressionAttributeValues={
+                ":sent": {"S": SENDING},
+                ":now": {"N": str(now)},
+                ":stale": {"N": str(now - SEND_LEASE_SECONDS)},
+            },
+        ),
     ]
 
 
-def send_email(email: Email) -> bool:
-    ssm = boto3.client("ssm")
-    dynamodb = boto3.client("dynamodb")
+def get_emails_to_be_sent(now: int) -> Iterator[Email]:
+    dynamodb_client = aws_client("dynamodb")
+    for query in scheduled_queries(now):
+        while True:
+            response = dynamodb_client.query(**query)
+            for item in response["Items"]:
+                yield Email.from_dynamodb_item(item)
 
-    pw_parameter = ssm.get_parameter(
-        Name=f"/bogamail/passwords/{email.sender.email.split('@')[0]}",
-        WithDecryption=True,
-    )
-    password = pw_parameter["Parameter"]["Value"]
+            if "LastEvaluatedKey" not in response:
+                break
+            query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def count_emails_to_be_sent(now: int) -> int:
+    dynamodb_client = aws_client("dynamodb")
+    count = 0
+    for query in scheduled_queries(now):
+        query["Select"] = "COUNT"
+        while True:
+            response = dynamodb_client.query(**query)
+            count += response["Count"]
+
+            if "LastEvaluatedKey" not in response:
+                break
+            query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    return count
 
+
+def claim_scheduled(email: Email, now: int) -> bool:
+    # conditional, so two overlapping schedule runs can't both claim an email;
+    # the claim time lets a later run take over one that was never finished
     try:
-        with smtplib.SMTP("smtp.gmail.com", 587) as server:
-            server.starttls()
-            server.login(email.sender.email, password)
-            server.send_message(email.message)
-            print(f"Email sent successfully to {email.recipient.email}")
+        aws_client("dynamodb").update_item(
+            TableName=mail_table(),
+            Key={
+                "id": {"S": email.get_message_id()},
+                "sender": {"S": email.sender.email},
+            },
+            UpdateExpression="SET sent = :sending, sending_since = :now",
+            ConditionExpression="sent = :unsent OR (sent = :sending AND "
+            "(attribute_not_exists(sending_since) OR sending_since < :stale))",
+            ExpressionAttributeValues={
+                ":sending": {"S": SENDING},
+                ":unsent": {"S": str(False)},
+                ":now": {"N": str(now)},
+                ":stale": {"N": str(now - SEND_LEASE_SECONDS)},
+            },
+        )
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            return False
+        raise
 
-        dynamodb.update_item(
+
+def release_scheduled(email: Email):
+    try:
+        aws_client("dynamodb").update_item(
             TableName=mail_table(),
-            Key={"id": {"S": email.get_message_id()}, "sender": {"S": email.sender.email}},
-            UpdateExpression="SET sent = :sent",
-            ExpressionAttributeValues={":sent": {"S": "true"}},
+            Key={
+                "id": {"S": email.get_message_id()},
+                "sender": {"S": email.sender.email},
+            },
+            UpdateExpression="SET sent = :unsent REMOVE sending_since",
+            ConditionExpression="sent = :sending",
+            ExpressionAttributeValues={
+                ":sending": {"S": SENDING},
+                ":unsent": {"S": str(False)},
+            },
         )
+    except ClientError as e:
+        # the lease still runs out, a later run picks it up then
+        print(f"Could not release {email.get_message_id()}: {e}")
 
-        return True
+
+def dispatch_scheduled(email: Email, now: int) -> str:
+    # a claim that errors (throttled past botocore's retries) fails this email
+    # alone; raised out of the future it would end the run with others in flight
+    try:
+        if not claim_scheduled(email, now):
+            return "skipped"
+    except ClientError as e:
+        print(f"Could not claim {email.get_message_id()}: {e}")
+        return "failed"
+
+    sent = False
+    try:
+        sent = send_email(email)
+    finally:
+        if not sent:
+            release_scheduled(email)
+    return "sent" if sent else "failed"
+
+
+def send_email(email: Email) -> bool:
+    try:
+        password = get_parameter(
+            f"/bogamail/passwords/{email.sender.email.split('@')[0]}"
+        )
+        smtp_pool.send(email.sender.email, password, email.message)
+        print(f"Email sent successfully to {email.recipient.email}")
     except Exception as e:
         print(f"Error sending email: {e}")
         return False
 
+    # the email has gone out whatever happens here, so a failed update must not
+    # report the send as failed and have it retried into a second copy
+    mark_sent(email)
+    return True
+
+
+def mark_sent(email: Email) -> bool:
+    for attempt in range(MARK_SENT_ATTEMPTS):
+        try:
+            aws_client("dynamodb").update_item(
+                TableName=mail_table(),
+                Key={
+                    "id": {"S": email.get_message_id()},
+                    "sender": {"S": email.sender.email},
+                },
+                UpdateExpression="SET sent = :sent REMOVE sending_since",
+                ExpressionAttributeValues={":sent": {"S": str(True)}},
+            )
+            return True
+        except Exception as e:
+            print(f"Could not mark {email.get_message_id()} sent: {e}")
+            if attempt + 1 < MARK_SENT_ATTEMPTS:
+                batch_backoff(attempt)
+
+    print(f"Sent {email.get_message_id()} but could not mark it sent")
+    return False
+
 
 def get_most_recent_message_id(from_email: str) -> str:
-    dynamodb_client = boto3.client("dynamodb")
+    dynamodb_client = aws_client("dynamodb")
     response = dynamodb_client.query(
         TableName=mail_table(),
         KeyConditionExpression="from = :from",
@@ -79,53 +238,191 @@ def get_most_recent_message_id(from_email: str) -> str:
     return None
 
 
+def delivery_key(ses_message: dict, raw: bytes, email: Email) -> str:
+    # one key per email the reply worker would be handed. The recipient is
+    # read from the To header rather than where ses delivered it, so the same
+    # message delivered to two personas builds the same email and is one
+    # delivery, answered once
+    message_id = peek_message_id(raw) or ses_message.get("mail", {}).get("messageId")
+    if message_id is None:
+        return None
+    return f"{message_id}|{email.sender.email}|{email.recipient.email}"
+
+
+def received_email(ses_message: dict, raw: bytes) -> Email:
+    email = Email.from_bytes(raw)
+    if not email.sender.email:
+        # a From without an address would be stored under an empty key; use
+        # the envelope sender ses saw instead
+        source = ses_message.get("mail", {}).get("source")
+        if not source:
+            raise ValueError("no sender address in From or the envelope")
+        email.sender = Contact(email.sender.name, source)
+    return email
+
+
 def receive_handler(event, context):
-    for record in event["Records"]:
-        sns_message = json.loads(record["body"])
-        ses_message = json.loads(sns_message["Message"])
-        print(sns_message)
+    # parse everything first, then write and enqueue in batches; any record
+    # that fails a step is reported back so only it is redelivered
+    received = []
+    failures = []
+    # delivery keys claimed but not yet stored and enqueued; whatever is left
+    # when the handler exits, however it exits, is released for the retry
+    claimed = set()
+
+    try:
+        for record in event["Records"]:
+            try:
+                sns_message = json.loads(record["body"])
+                ses_message = json.loads(sns_message["Message"])
+                print(sns_message)
+
+                raw = ses_content_bytes(ses_message)
+                # only the header block is parsed here, the body waits
+                email = received_email(ses_message, raw)
+                key = delivery_key(ses_message, raw, email)
+                if key is not None:
+                    if not claim_delivery(key):
+                        print(f"Dropping duplicate delivery: {key}")
+                        continue
+                    claimed.add(key)
+
+                received.append((record["messageId"], key, email))
+                print(f"Received message: {email.get_message_id()}")
+            except Exception as e:
+                print(f"Error parsing record {record['messageId']}: {e}")
+                failures.append(record["messageId"])
+
+        not_written = {id(email) for email in write_emails([e for _, _, e in received])}
+        written = [email for _, _, email in received if id(email) not in not_written]
+        not_enqueued = {id(email) for email in enqueue_emails_for_client(written)}
+
+        for record_id, key, email in received:
+            if id(email) in not_written or id(email) in not_enqueued:
+                print(f"Error storing or enqueuing message: {email.get_message_id()}")
+                failures.append(record_id)
+            else:
+                print(f"Enqueued message: {email.get_message_id()}")
+                if key is not None:
+                    complete_delivery(key)
+                    claimed.discard(key)
+    finally:
+        for key in claimed:
+            release_delivery(key)
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps("Messages processed successfully"),
+        "batchItemFailures": [{"itemIdentifier": f} for f in failures],
+    }
+
+
+def already_sent(email: Email) -> bool:
+    # a redelivered record whose email went out on an earlier attempt
+    response = aws_client("dynamodb").get_item(
+        TableName=mail_table(),
+        Key={"id": {"S": email.get_message_id()}, "sender": {"S": email.sender.email}},
+        ProjectionExpression="sent",
+    )
+    return response.get("Item", {}).get("sent", {}).get("S", "").lower() == "true"
 
-        decoded_message = (
-            base64.b64decode(ses_message["content"])
-            if is_base64(ses_message["content"])
-            else ses_message["content"]
-        ).decode("utf-8")
 
-        email = Email.from_message_string(decoded_message)
-        email.write()
+def send_record(record: dict) -> bool:
+    this_email, envelope = decode_envelope(record["body"])
+    print({key: value for key, value in envelope.items() if key != "email"})
 
-        print(f"Received message: {email.get_message_id()}")
-        email.enqueue_for_client()
-        print(f"Enqueued message: {email.get_message_id()}")
+    if envelope.get("send_after", 0) != 0:
+        # stored unsent; schedule_handler sends it once it is due. Only if it
+        # isn't stored yet: a redelivered record must not put an email the
+        # scheduler has already sent back to unsent
+        try:
+            this_email.write(send_after=envelope["send_after"], if_new=True)
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            print(f"Already scheduled: {this_email.get_message_id()}")
+        return True
+
+    if already_sent(this_email):
+        print(f"Already sent: {this_email.get_message_id()}")
+        return True
+
+    if not send_email(this_email):
+        return False
+
+    # the email is out; a failure from here on must not get it resent
+    try:
+        this_email.sent = True
+        this_email.write()
+    except Exception as e:
+        print(f"Error storing sent email {this_email.get_message_id()}: {e}")
 
-    return {"statusCode": 200, "body": json.dumps("Messages processed successfully")}
+    return True
 
 
 def send_handler(event, context):
-    for record in event["Records"]:
-        decoded_email = json.loads(record["body"])
-        print(decoded_email)
-        this_email = Email.from_message_string(decoded_email.get("email"))
+    # records are independent, so send them side by side and report back only
+    # the ones that failed instead of failing (and resending) the whole batch
+    failures = []
 
-        if decoded_email.get("send_after", 0) == 0:
+    with ThreadPoolExecutor(max_workers=SEND_CONCURRENCY) as executor:
+        futures = {
+            executor.submit(send_record, record): record["messageId"]
+            for record in event["Records"]
+        }
+        for future, message_id in futures.items():
             try:
-                send_email(this_email)
-                this_email.sent = True
-                this_email.write()
-            except:
-                return {"statusCode": 500, "body": json.dumps("Error sending email")}
+                sent = future.result()
+            except Exception as e:
+                print(f"Error sending record {message_id}: {e}")
+                sent = False
+
+            if not sent:
+                failures.append(message_id)
 
-    return {"statusCode": 200, "body": json.dumps("Messages processed successfully")}
+    return {
+        "statusCode": 200,
+        "body": json.dumps("Messages processed successfully"),
+        "batchItemFailures": [{"itemIdentifier": f} for f in failures],
+    }
 
 
 def schedule_handler(event, context):
-    for this_email in get_emails_to_be_sent():
-        send_email(this_email)
+    start = time.time()
+    now = int(start)
+    results = Counter()
+    pending = set()
 
-        return {
-            "statusCode": 200,
-            "body": json.dumps("Messages processed successfully"),
-        }
+    def collect(done):
+        for future in done:
+            results[future.result()] += 1
+
+    with ThreadPoolExecutor(max_workers=DISPATCH_CONCURRENCY) as executor:
+        for this_email in get_emails_to_be_sent(now):
+            if (
+                context is not None
+                and context.get_remaining_time_in_millis() < DISPATCH_DEADLINE_MARGIN_MS
+            ):
+                print("Stopping dispatch ahead of the lambda deadline")
+                break
+
+            if len(pending) >= DISPATCH_CONCURRENCY:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending.add(executor.submit(dispatch_scheduled, this_email, now))
+
+        collect(wait(pending).done)
+
+    elapsed = time.time() - start
+    report = {
+        **results,
+        "backlog": count_emails_to_be_sent(now),
+        "seconds": round(elapsed, 2),
+        "per_second": round(results["sent"] / elapsed, 2) if elapsed else 0,
+    }
+    print(f"Scheduled send: {report}")
+
+    return {"statusCode": 200, "body": json.dumps(report)}
 
 
 if __name__ == "__main__":
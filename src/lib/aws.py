@@ -0,0 +1,51 @@
+import boto3
+import threading
+from botocore.config import Config
+
+# one session and one client per service for the whole process, so lambda
+# warm starts and the long-running worker reuse credentials, endpoint
+# resolution and open https connections instead of redoing them per call
+CLIENT_CONFIG = Config(
+    max_pool_connections=32,
+    tcp_keepalive=True,
+    connect_timeout=5,
+    read_timeout=60,
+    retries={"max_attempts": 5, "mode": "adaptive"},
+)
+
+session_cache = None
+client_cache = {}
+resource_cache = {}
+lock = threading.Lock()
+
+
+def aws_session() -> boto3.session.Session:
+    global session_cache
+    if session_cache is None:
+        with lock:
+            if session_cache is None:
+                session_cache = boto3.session.Session()
+    return session_cache
+
+
+def aws_client(name: str):
+    client = client_cache.get(name)
+    if client is None:
+        session = aws_session()
+        # sessions are not thread-safe, clients are; build them under the lock
+        with lock:
+            if name not in client_cache:
+                client_cache[name] = session.client(name, config=CLIENT_CONFIG)
+            client = client_cache[name]
+    return client
+
+
+def aws_resource(name: str):
+    resource = resource_cache.get(name)
+    if resource is None:
+        session = aws_session()
+        with lock:
+            if name not in resource_cache:
+                resource_cache[name] = session.resource(name, config=CLIENT_CONFIG)
+            resource = resource_cache[name]
+    return resource
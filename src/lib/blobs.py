@@ -0,0 +1,78 @@
+import hashlib
+import logging
+import os
+from botocore.exceptions import ClientError
+from lib.aws import aws_client
+from lib.params import setting
+
+blob_store_cache = None
+
+
+def blob_key(data: bytes) -> str:
+    return "sha256/" + hashlib.sha256(data).hexdigest()
+
+
+class LocalBlobStore:
+    # filesystem backend, for running the handlers and worker locally
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, key: str) -> str:
+        digest = key.split("/")[-1]
+        return os.path.join(self.root, digest[:2], digest)
+
+    def put(self, data: bytes) -> str:
+        key = blob_key(data)
+        path = self.path(key)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "wb") as f:
+                f.write(data)
+            os.replace(path + ".tmp", path)
+        return key
+
+    def get(self, key: str) -> bytes:
+        with open(self.path(key), "rb") as f:
+            return f.read()
+
+
+class S3BlobStore:
+    def __init__(self, bucket: str):
+        self.bucket = bucket
+        self.s3 = aws_client("s3")
+        self.known = set()
+
+    def put(self, data: bytes) -> str:
+        # blobs are keyed by content, so an attachment sent by a whole campaign
+        # is uploaded once and every later copy is just a head request
+        key = blob_key(data)
+        if key in self.known:
+            return key
+
+        try:
+            self.s3.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("404", "NoSuchKey", "NotFound"):
+                raise
+            self.s3.put_object(Bucket=self.bucket, Key=key, Body=data)
+            logging.info(f"stored blob {key} ({len(data)} bytes)")
+
+        self.known.add(key)
+        return key
+
+    def get(self, key: str) -> bytes:
+        return self.s3.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+
+
+def blob_bucket() -> str:
+    return setting("BLOB_BUCKET", "/bogamail/blob_bucket")
+
+
+def blob_store():
+    global blob_store_cache
+    if blob_store_cache is None:
+        if os.environ.get("BLOB_DIR"):
+            blob_store_cache = LocalBlobStore(os.environ.get("BLOB_DIR"))
+        else:
+            blob_store_cache = S3BlobStore(blob_bucket())
+    return blob_store_cache
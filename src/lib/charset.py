@@ -0,0 +1,67 @@
+import codecs
+import logging
+from collections import Counter
+import chardet
+
+# only this much of a payload is handed to chardet; it is the slowest step in
+# the parse and a sample is plenty to pick a charset for a whole part
+DETECT_SAMPLE_BYTES = 16 * 1024
+
+decode_tier_counts = Counter()
+
+
+def known_charset(charset: str) -> bool:
+    # bytes-to-bytes codecs like base64, hex or rot13 look up fine but can't
+    # decode a payload to text
+    try:
+        return codecs.lookup(charset)._is_text_encoding
+    except LookupError:
+        return False
+
+
+def decode_with_tier(payload: bytes, declared_charset: str = None) -> tuple[str, str]:
+    # 1. the charset the part says it is in
+    if declared_charset and known_charset(declared_charset):
+        try:
+            return payload.decode(declared_charset), "declared"
+        except (UnicodeDecodeError, LookupError):
+            pass
+
+    # 2. plain ascii / utf-8, which covers almost everything else
+    if payload.isascii():
+        return payload.decode("ascii"), "ascii"
+    try:
+        return payload.decode("utf-8"), "utf-8"
+    except UnicodeDecodeError:
+        pass
+
+    # 3. statistical detection on a bounded sample
+    detected = chardet.detect(payload[:DETECT_SAMPLE_BYTES])["encoding"]
+    if detected and known_charset(detected):
+        try:
+            return payload.decode(detected), "detected"
+        except (UnicodeDecodeError, LookupError):
+            pass
+
+    fallback = next(
+        (c for c in (detected, declared_charset) if c and known_charset(c)), "utf-8"
+    )
+    return payload.decode(fallback, "replace"), "replaced"
+
+
+def decode_payload(payload, declared_charset: str = None):
+    if payload is None:
+        return ""
+    if not isinstance(payload, bytes):
+        return payload
+
+    text, tier = decode_with_tier(payload, declared_charset)
+    decode_tier_counts[tier] += 1
+
+    if tier in ("detected", "replaced"):
+        logging.info(
+            f"charset fallback '{tier}' (declared {declared_charset}); "
+            f"tier counts so far: {dict(decode_tier_counts)}"
+        )
+
+    return text
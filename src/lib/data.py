@@ -1,41 +1,86 @@
-import boto3
 from dataclasses import dataclass, field
 from typing import Self
 import json
 import logging
-import os
 import time
+from decimal import Decimal
+from lib.aws import aws_resource
+from lib.params import setting
 
-queue_url_cache = {}
-data_table_cache = None
 logging.basicConfig(level=logging.INFO)
 
 
 def data_table() -> str:
-    global data_table_cache
-    if data_table_cache is not None:
-        return data_table_cache
-
-    if os.environ.get("DATA_TABLE"):
-        return os.environ.get("DATA_TABLE")
-    else:
-        ssm = boto3.client("ssm")
-        parameter = ssm.get_parameter(Name=f"/bogamail/data_table")
-        data_table_cache = parameter["Parameter"]["Value"]
-        return data_table_cache
+    return setting("DATA_TABLE", "/bogamail/data_table")
 
 
 def store_scam_data(scammer_email_addr: str, data: dict) -> None:
-    dynamodb = boto3.resource("dynamodb")
+    # an update rather than a put, so the summaries kept next to the data on
+    # the same item are left alone
+    dynamodb = aws_resource("dynamodb")
+    table = dynamodb.Table(data_table())
+    table.update_item(
+        Key={"email": scammer_email_addr},
+        UpdateExpression="SET #data = :data",
+        ExpressionAttributeNames={"#data": "data"},
+        ExpressionAttributeValues={":data": json.dumps(data)},
+    )
+
+
+def get_summary(email: str, conversation_id: str) -> tuple[str, float]:
+    # the rolling summary of one conversation with the scammer, up to and
+    # including the email sent at the returned timestamp; each of our personas
+    # has its own conversation with them, so summaries are kept per thread
+    dynamodb = aws_resource("dynamodb")
+    table = dynamodb.Table(data_table())
+    response = table.get_item(
+        Key={"email": email},
+        ProjectionExpression="summaries.#conversation",
+        ExpressionAttributeNames={"#conversation": conversation_id},
+    )
+    summary = response.get("Item", {}).get("summaries", {}).get(conversation_id, {})
+    return summary.get("summary", ""), float(summary.get("summarized_through", 0))
+
+
+def store_summary(
+    email: str, conversation_id: str, summary: str, summarized_through: float
+) -> None:
+    # each conversation's entry in the summaries map is set on its own, so two
+    # conversations with one scammer being answered at once can't overwrite
+    # each other's summary
+    dynamodb = aws_resource("dynamodb")
     table = dynamodb.Table(data_table())
-    table.put_item(Item={"email": scammer_email_addr, "data": json.dumps(data)})
+    update = dict(
+        Key={"email": email},
+        UpdateExpression="SET summaries.#conversation = :summary",
+        ConditionExpression="attribute_exists(summaries)",
+        ExpressionAttributeNames={"#conversation": conversation_id},
+        ExpressionAttributeValues={
+            ":summary": {
+                "summary": summary,
+                "summarized_through": Decimal(str(summarized_through)),
+            }
+        },
+    )
+    try:
+        table.update_item(**update)
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        # the first summary for this scammer; create the map, unless another
+        # conversation just did, and set the entry again
+        table.update_item(
+            Key={"email": email},
+            UpdateExpression="SET summaries = if_not_exists(summaries, :empty)",
+            ExpressionAttributeValues={":empty": {}},
+        )
+        table.update_item(**update)
 
 
 def get_scam_data(email: str) -> dict:
-    dynamodb = boto3.resource("dynamodb")
+    dynamodb = aws_resource("dynamodb")
     table = dynamodb.Table(data_table())
     response = table.get_item(Key={"email": email})
-    if "Item" not in response:
+    # an item may hold only summaries, with no scam data stored yet
+    if "data" not in response.get("Item", {}):
         return {}
     else:
         return json.loads(response["Item"]["data"])
@@ -0,0 +1,120 @@
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from botocore.exceptions import ClientError
+from lib.aws import aws_client
+from lib.headers import header_block
+from lib.params import setting
+
+# ses -> sns -> sqs is at-least-once; a redelivered email is dropped here,
+# before it is parsed, stored or handed to the reply worker
+RECENT_IDS_SIZE = 2048
+DEDUP_TTL_SECONDS = 7 * 24 * 60 * 60
+# longer than the receive lambda can run, a claim older than this belongs to
+# an invocation that crashed or timed out
+DEDUP_LEASE_SECONDS = 2 * 300
+PENDING = "pending"
+DONE = "done"
+
+MESSAGE_ID_HEADER = re.compile(
+    rb"^message-id:[ \t]*(?:\r?\n[ \t]+)?<?([^<>\s]+)>?", re.IGNORECASE | re.MULTILINE
+)
+
+recent_ids = OrderedDict()
+lock = threading.Lock()
+
+
+def dedup_table() -> str:
+    return setting("DEDUP_TABLE", "/bogamail/dedup_table")
+
+
+def peek_message_id(raw: bytes) -> str:
+    # just the header block, no mime parse
+    match = MESSAGE_ID_HEADER.search(header_block(raw))
+    if match:
+        return match.group(1).decode("ascii", "replace")
+    return None
+
+
+def seen(key: str) -> bool:
+    with lock:
+        if key in recent_ids:
+            recent_ids.move_to_end(key)
+            return True
+        return False
+
+
+def remember(key: str):
+    with lock:
+        recent_ids[key] = True
+        recent_ids.move_to_end(key)
+        if len(recent_ids) > RECENT_IDS_SIZE:
+            recent_ids.popitem(last=False)
+
+
+def claim_delivery(key: str) -> bool:
+    # True when this invocation now owns the delivery. The claim is a lease:
+    # it is only final once complete_delivery marks it done, so a run that
+    # dies part way through can't leave the email looking like a duplicate
+    if seen(key):
+        return False
+
+    now = int(time.time())
+    try:
+        aws_client("dynamodb").put_item(
+            TableName=dedup_table(),
+            Item={
+                "id": {"S": key},
+                "status": {"S": PENDING},
+                "lease_until": {"N": str(now + DEDUP_LEASE_SECONDS)},
+                "expires": {"N": str(now + DEDUP_TTL_SECONDS)},
+            },
+            ConditionExpression="attribute_not_exists(id) OR "
+            "(#status = :pending AND lease_until < :now)",
+            ExpressionAttributeNames={"#status": "status"},
+            ExpressionAttributeValues={
+                ":pending": {"S": PENDING},
+                ":now": {"N": str(now)},
+            },
+        )
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            return False
+        # fail open, a duplicate reply is better than a lost email
+        logging.warning(f"dedup check for {key} failed: {e}")
+        return True
+
+
+def complete_delivery(key: str):
+    # the email is stored and enqueued, later deliveries are duplicates
+    remember(key)
+    try:
+        aws_client("dynamodb").update_item(
+            TableName=dedup_table(),
+            Key={"id": {"S": key}},
+            UpdateExpression="SET #status = :done REMOVE lease_until",
+            ExpressionAttributeNames={"#status": "status"},
+            ExpressionAttributeValues={":done": {"S": DONE}},
+        )
+    except ClientError as e:
+        logging.warning(f"could not complete dedup key {key}: {e}")
+
+
+def release_delivery(key: str):
+    # processing failed after the claim; let the redelivery through
+    with lock:
+        recent_ids.pop(key, None)
+    try:
+        aws_client("dynamodb").delete_item(
+            TableName=dedup_table(),
+            Key={"id": {"S": key}},
+            ConditionExpression="#status = :pending",
+            ExpressionAttributeNames={"#status": "status"},
+            ExpressionAttributeValues={":pending": {"S": PENDING}},
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            logging.warning(f"could not release dedup key {key}: {e}")
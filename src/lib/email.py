@@ -1,249 +1,389 @@
-import boto3
+import base64
 import email
 from dataclasses import dataclass, field
-import re
-import os
 import uuid
 from typing import Self
 import json
 import logging
+import random
 import time
+import zlib
+from botocore.exceptions import ClientError
 from email.message import EmailMessage
-from bs4 import BeautifulSoup
-import chardet
+from lib.aws import aws_client
+from lib.blobs import blob_store
+from lib.charset import decode_payload
+from lib.html_text import html_to_text
+from lib.params import get_parameter, setting
+from lib.headers import (
+    Contact,
+    conversation_id,
+    decode_words,
+    normalize_message_id,
+    normalize_references,
+    parse_headers,
+    reference_token,
+)
+
+# version 2 envelopes carry routing metadata next to the message and compress
+# anything over the threshold, keeping big mails well under the sqs size limit
+WIRE_VERSION = 2
+WIRE_COMPRESS_THRESHOLD = 16 * 1024
+
+# messages bigger than this are kept in the blob store and the mail item only
+# holds the key, well clear of the dynamodb item size limit
+INLINE_MESSAGE_LIMIT = 64 * 1024
+
+# everything from_dynamodb_item reads, as expression attribute names
+THREAD_ATTRIBUTES = {
+    f"#{name}": name
+    for name in (
+        "id",
+        "sender",
+        "sender_name",
+        "recipient",
+        "recipient_name",
+        "subject",
+        "message",
+        "message_key",
+        "references",
+        "attachments",
+        "sent",
+        "ts",
+    )
+}
+
+# service limits for BatchWriteItem and SendMessageBatch
+DYNAMODB_BATCH_SIZE = 25
+SQS_BATCH_SIZE = 10
+SQS_BATCH_BYTES = 256 * 1024
+MAX_BATCH_ATTEMPTS = 5
+# batch errors worth another try; anything else rejects the batch for good
+RETRYABLE_ERRORS = {
+    "InternalServerError",
+    "ProvisionedThroughputExceededException",
+    "RequestLimitExceeded",
+    "ServiceUnavailable",
+    "ThrottlingException",
+}
 
-queue_url_cache = {}
-mail_table_cache = None
 logging.basicConfig(level=logging.INFO)
 
 
 def queue_url(name: str) -> str:
-    global queue_url_cache
-    if queue_url_cache.get(name) is not None:
-        return queue_url_cache[name]
-
-    if os.environ.get(f"{name.upper()}_QUEUE_URL"):
-        return os.environ.get(f"{name.upper()}_QUEUE_URL")
-    else:
-        ssm = boto3.client("ssm")
-        parameter = ssm.get_parameter(Name=f"/bogamail/queue_url/{name.lower()}")
-        queue_url_cache[name] = parameter["Parameter"]["Value"]
-        return queue_url_cache[name]
+    return setting(f"{name.upper()}_QUEUE_URL", f"/bogamail/queue_url/{name.lower()}")
 
 
 def mail_table() -> str:
-    global mail_table_cache
-    if mail_table_cache is not None:
-        return mail_table_cache
-
-    if os.environ.get("MAIL_TABLE"):
-        return os.environ.get("MAIL_TABLE")
-    else:
-        ssm = boto3.client("ssm")
-        parameter = ssm.get_parameter(Name=f"/bogamail/mail_table")
-        mail_table_cache = parameter["Parameter"]["Value"]
-        return mail_table_cache
-
-
-def clean_reference(ref):
-    return re.sub(r"[\r\n]+$", "", ref)
-
-
-def extract_id(id_header):
-    match = re.search(r"^<(.+)>", id_header)
-    if match:
-        return match.group(1).strip()
-    return None
+    return setting("MAIL_TABLE", "/bogamail/mail_table")
 
 
 def generate_message_id(domain="gmail.com"):
-    return "<" + str(uuid.uuid4()) + f"@{domain}>"
-
-
-def decode_payload(payload):
-    # Detect and decode payload using chardet
-    if isinstance(payload, bytes):
-        detected = chardet.detect(payload)
-        try:
-            return payload.decode(detected["encoding"])
-        except UnicodeDecodeError:
-            return "Failed to decode with detected encoding."
-    else:
-        return payload
+    # bare id, the same form extract_id() gives for received mail; the angle
+    # brackets are added when it is written into a header
+    return str(uuid.uuid4()) + f"@{domain or 'gmail.com'}"
 
 
 def get_plain_text_body(email_message: EmailMessage) -> str:
     text_content = ""
     html_content = ""
 
-    if email_message.is_multipart():
-        for part in email_message.walk():
-            charset = part.get_content_charset() or "utf-8"
-            content_type = part.get_content_type()
-
-            if part.is_multipart():
-                for subpart in part.get_payload():
-                    if subpart.get_content_type() == "text/plain":
-                        text_content += decode_payload(subpart.get_payload(decode=True))
-                    elif subpart.get_content_type() == "text/html":
-                        html_content += decode_payload(subpart.get_payload(decode=True))
-            else:
-                payload = part.get_payload(decode=True)
-                try:
-                    if content_type == "text/plain":
-                        text_content += decode_payload(payload)
-                    elif content_type == "text/html":
-                        html_content += decode_payload(payload)
-                except (UnicodeDecodeError, LookupError) as e:
-                    print(f"decoding failed for a part with charset {charset}: {e}")
-    else:
-        payload = email_message.get_payload(decode=True)
-        charset = email_message.get_content_charset() or "utf-8"
-        try:
-            text_content += decode_payload(payload)
-        except (UnicodeDecodeError, LookupError) as e:
-            print(
-                f"decoding failed for single-part message with charset {charset}: {e}"
+    # walk() yields the message itself and every nested part, so containers
+    # are skipped here rather than descended into a second time
+    for part in email_message.walk():
+        if part.is_multipart():
+            continue
+
+        # html goes through html_to_text however it is nested, including a
+        # message that is nothing but one text/html part
+        content_type = part.get_content_type()
+        if content_type == "text/html":
+            html_content += decode_payload(
+                part.get_payload(decode=True), part.get_content_charset()
+            )
+        elif not email_message.is_multipart() or content_type == "text/plain":
+            text_content += decode_payload(
+                part.get_payload(decode=True), part.get_content_charset()
             )
 
     if text_content:
         return text_content.strip()
 
     if html_content:
-        soup = BeautifulSoup(html_content, "html.parser")
-        return soup.get_text().strip()
+        return html_to_text(html_content)
 
     return "No useful text could be extracted."
 
 
-@dataclass
-class Contact:
-    name: str
-    email: str
+@dataclass(slots=True)
+class Attachment:
+    # attachment bytes live in the blob store; items and envelopes only carry
+    # the content key, and the data is fetched on first access
+    filename: str
+    content_type: str
+    size: int
+    key: str = None
+    _data: bytes = field(default=None, repr=False)
 
-    def __init__(self, name: str, email: str):
-        self.name = name
-        self.email = email
+    @property
+    def data(self) -> bytes:
+        if self._data is None:
+            self._data = blob_store().get(self.key)
+        return self._data
+
+    def store(self) -> str:
+        if self.key is None:
+            self.key = blob_store().put(self._data)
+        return self.key
 
     @classmethod
-    def from_header(self, header: str) -> Self:
-        match = re.search(
-            r"^\"?(.*?)\"?\s*<?([^<>@\s]+@[^<>@\s]+\.[^<>@\s]+)>?$", header
+    def from_part(self, part: EmailMessage) -> Self:
+        data = part.get_payload(decode=True) or b""
+        return self(
+            filename=decode_words(part.get_filename()),
+            content_type=part.get_content_type(),
+            size=len(data),
+            _data=data,
         )
 
-        if match:
-            return Contact(match.group(1).strip(), match.group(2).strip())
+    @classmethod
+    def from_dynamodb_value(self, value: dict) -> Self:
+        attachment = value["M"]
+        return self(
+            filename=attachment["filename"]["S"],
+            content_type=attachment["content_type"]["S"],
+            size=int(attachment["size"]["N"]),
+            key=attachment["key"]["S"],
+        )
+
+    def as_dynamodb_value(self) -> dict:
+        return {
+            "M": {
+                "filename": {"S": self.filename},
+                "content_type": {"S": self.content_type},
+                "size": {"N": str(self.size)},
+                "key": {"S": self.store()},
+            }
+        }
 
-    def to_header(self) -> str:
-        return f"{self.name} <{self.email}>"
 
+def get_attachments(email_message: EmailMessage) -> list[Attachment]:
+    return [
+        Attachment.from_part(part)
+        for part in email_message.walk()
+        if not part.is_multipart() and part.get_content_disposition() == "attachment"
+    ]
 
-@dataclass
+
+@dataclass(slots=True)
 class Email:
+    # the raw message is kept as received and only the headers are parsed up
+    # front; the full message, body text and attachments are built on first use
     sender: Contact
     recipient: Contact
     subject: str
-    body: str
-    references: list[str] = (field(default_factory=list),)
-    _message_id: str = None
-    sent: bool = False
-    message: email.message.EmailMessage = None
-    receipt_handle: str = None
-    ts: int = time.time()
+    references: list[str]
+    _body: str = field(repr=False)
+    _message: EmailMessage = field(repr=False)
+    _attachments: list[Attachment] = field(repr=False)
+    _raw: bytes | str = field(repr=False)
+    _raw_key: str = field(repr=False)
+    _serialized: str = field(repr=False)
+    _message_id: str
+    sent: bool
+    receipt_handle: str
+    ts: int
 
     def __init__(
         self,
         sender: Contact,
         recipient: Contact,
         subject: str,
-        body: str,
+        body: str = None,
         references: list[str] = None,
         message_id: str = None,
         message: email.message.EmailMessage = None,
         receipt_handle: str = None,
         ts: int = 0,
+        raw: bytes | str = None,
+        sent: bool = False,
+        raw_key: str = None,
     ):
         self.sender = sender
         self.recipient = recipient
         self.subject = subject
-        self.body = body
-        self.references = references
+        self._body = body
+        self.references = references if references is not None else []
         self._message_id = message_id
-        self.message = message
-        self.sent = False
+        self._message = message
+        self._attachments = None
+        self._raw = raw
+        self._raw_key = raw_key
+        self._serialized = None
+        self.sent = sent
         self.receipt_handle = receipt_handle
         self.ts = ts if ts else time.time()
 
+    @property
+    def message(self) -> EmailMessage:
+        if self._message is None:
+            if self._raw is None and self._raw_key is not None:
+                self._raw = blob_store().get(self._raw_key)
+
+            if isinstance(self._raw, bytes):
+                self._message = email.message_from_bytes(self._raw)
+            elif self._raw is not None:
+                self._message = email.message_from_string(self._raw)
+            else:
+                self._message = self.as_message()
+        return self._message
+
+    @property
+    def body(self) -> str:
+        if self._body is None:
+            self._body = get_plain_text_body(self.message)
+        return self._body
+
+    @body.setter
+    def body(self, body: str):
+        self._body = body
+        self._serialized = None
+
+    @property
+    def attachments(self) -> list[Attachment]:
+        if self._attachments is None:
+            self._attachments = get_attachments(self.message)
+        return self._attachments
+
     @classmethod
     def from_message_string(
-        self, email_string: str, receipt_handle: str = None
+        self, email_string: str, receipt_handle: str = None, message_id: str = None
     ) -> Self:
-        parsed_email = email.message_from_string(email_string)
-        sender = Contact.from_header(parsed_email["From"])
-        recipient = Contact.from_header(parsed_email["To"])
-
-        references = (
-            [clean_reference(ref) for ref in parsed_email["References"].split(" ")]
-            if parsed_email["References"]
-            else []
+        return self.from_parsed(
+            parse_headers(email_string),
+            receipt_handle,
+            raw=email_string,
+            message_id=message_id,
         )
 
-        cleaned_references = [clean_reference(ref) for ref in references]
+    @classmethod
+    def from_bytes(self, raw: bytes, receipt_handle: str = None) -> Self:
+        # parse straight from the wire bytes; no utf-8 decode of the whole message
+        return self.from_parsed(parse_headers(raw), receipt_handle, raw=raw)
 
-        if parsed_email.get("Message-ID"):
-            message_id = extract_id(parsed_email.get("Message-ID"))
-        else:
-            message_id = generate_message_id(sender.email.split("@")[1])
+    @classmethod
+    def from_parsed(
+        self,
+        parsed_email: EmailMessage,
+        receipt_handle: str = None,
+        raw: bytes | str = None,
+        message_id: str = None,
+    ) -> Self:
+        sender = Contact.from_header(parsed_email["From"])
+        recipient = Contact.from_header(parsed_email["To"])
+        references = normalize_references(parsed_email["References"])
+        message_id = (
+            message_id
+            or normalize_message_id(parsed_email["Message-ID"])
+            or generate_message_id(sender.domain())
+        )
 
         return self(
             sender=sender,
             recipient=recipient,
-            subject=parsed_email["Subject"],
-            body=get_plain_text_body(parsed_email),
-            references=cleaned_references,
+            subject=decode_words(parsed_email["Subject"]),
+            references=references,
             message_id=message_id,
-            message=parsed_email,
+            message=None if raw is not None else parsed_email,
             receipt_handle=receipt_handle,
             ts=int(time.time()),
+            raw=raw,
         )
 
     @classmethod
     def from_id(self, id: str, sender: str) -> Self:
-        dynamodb = boto3.client("dynamodb")
+        dynamodb = aws_client("dynamodb")
         response = dynamodb.get_item(
             TableName=mail_table(),
             Key={"id": {"S": id}, "sender": {"S": sender}},
         )
 
         if "Item" in response:
-            return Email.from_message_string(response["Item"].get("message")["S"])
+            return Email.from_dynamodb_item(response["Item"])
         else:
             return None
 
+    @classmethod
+    def from_dynamodb_item(self, item: dict) -> Self:
+        if "message" in item:
+            # the item's id, not the stored message's header; items written
+            # before as_message() added a Message-ID header have none
+            email = self.from_message_string(
+                item["message"]["S"], message_id=item["id"]["S"]
+            )
+        else:
+            # oversized message, offloaded to the blob store by as_dynamodb_item
+            email = self(
+                sender=Contact(item["sender_name"]["S"], item["sender"]["S"]),
+                recipient=Contact(item["recipient_name"]["S"], item["recipient"]["S"]),
+                subject=item["subject"]["S"],
+                references=[
+                    ref["S"] for ref in item.get("references", {}).get("L", [])
+                ],
+                message_id=item["id"]["S"],
+                raw_key=item["message_key"]["S"],
+            )
+
+        if "attachments" in item:
+            email._attachments = [
+                Attachment.from_dynamodb_value(value)
+                for value in item["attachments"]["L"]
+            ]
+        if "ts" in item:
+            email.ts = int(item["ts"]["N"])
+        if "sent" in item:
+            email.sent = item["sent"]["S"].lower() == "true"
+
+        return email
+
     def get_message_id(self) -> str:
         if self._message_id:
             return self._message_id
         else:
-            self._message_id = generate_message_id(self.sender.email.split("@")[1])
+            self._message_id = generate_message_id(self.sender.domain())
 
         return self._message_id
 
+    def conversation_id(self) -> str:
+        return conversation_id(
+            self.references,
+            self.get_message_id(),
+            self.sender.email,
+            self.recipient.email,
+        )
+
     def as_message(self):
         msg = email.message.EmailMessage()
         msg["From"] = self.sender.to_header()
         msg["To"] = self.recipient.to_header()
         msg["Subject"] = self.subject
+        msg["Message-ID"] = reference_token(self.get_message_id())
 
-        clean_references = " ".join([clean_reference(ref) for ref in self.references])
-
-        if clean_references:
-            msg["References"] = clean_references
+        if self.references:
+            msg["References"] = " ".join(self.references)
 
         msg.set_content(self.body)
         return msg
 
+    def as_string(self) -> str:
+        # the rendered message is what goes on the queues and into the table;
+        # build it once per email rather than once per use
+        if self._serialized is None:
+            self._serialized = self.as_message().as_string()
+        return self._serialized
+
     def enqueue_for_client(self):
-        sqs = boto3.client("sqs")
+        sqs = aws_client("sqs")
         logging.info(
             f"enqueuing email to {self.recipient.email}: subject: {self.subject}, body: {self.body}"
         )
@@ -253,8 +393,7 @@ class Email:
         )
 
     def reply(self, subject, body):
-        sqs = boto3.client("sqs")
-        ssm = boto3.client("ssm")
+        sqs = aws_client("sqs")
 
         logging.info(
             f"deleting message {self.receipt_handle[:8]}... from receive queue"
@@ -263,63 +402,39 @@ class Email:
             QueueUrl=queue_url("client"), ReceiptHandle=self.receipt_handle
         )
 
-        name_parameter = ssm.get_parameter(
-            Name=f"/bogamail/names/{self.recipient.email.split('@')[0]}",
-            WithDecryption=True,
-        )
-        name = name_parameter["Parameter"]["Value"]
-        sender = Contact(name, self.recipient.email)
+        name = get_parameter(f"/bogamail/names/{self.recipient.email.split('@')[0]}")
+        sender = Contact(name or self.recipient.name, self.recipient.email)
 
         return Email(
             sender=sender,
             recipient=self.sender,
             subject=subject,
             body=body,
-            references=[clean_reference(ref) for ref in self.references]
-            + [clean_reference(self.get_message_id())],
+            references=self.references + [reference_token(self.get_message_id())],
         )
 
-    def thread(self):
-        dynamodb = boto3.client("dynamodb")
-
-        sender_response = dynamodb.query(
+    def thread(self) -> list[Self]:
+        dynamodb = aws_client("dynamodb")
+        query = dict(
             TableName=mail_table(),
-            IndexName="SenderThreadIndex",
-            KeyConditionExpression="sender = :sender",
-            FilterExpression="recipient = :recipient",
-            ExpressionAttributeValues={
-                ":sender": {"S": self.sender.email},
-                ":recipient": {"S": self.recipient.email},
-            },
-        )
-
-        recipient_response = dynamodb.query(
-            TableName=mail_table(),
-            IndexName="SenderThreadIndex",
-            KeyConditionExpression="sender = :sender",
-            FilterExpression="recipient = :recipient",
-            ExpressionAttributeValues={
-                ":sender": {"S": self.recipient.email},
-                ":recipient": {"S": self.sender.email},
-            },
+            IndexName="ConversationIndex",
+            KeyConditionExpression="conversation = :conversation",
+            ProjectionExpression=", ".join(THREAD_ATTRIBUTES.keys()),
+            ExpressionAttributeNames=THREAD_ATTRIBUTES,
+            ExpressionAttributeValues={":conversation": {"S": self.conversation_id()}},
+            ScanIndexForward=False,
         )
 
         thread = []
-        if "Items" in sender_response:
-            for item in sender_response["Items"]:
-                thread.append(Email.from_message_string(item["message"]["S"]))
-
-        if "Items" in recipient_response:
-            for item in recipient_response["Items"]:
-                thread.append(Email.from_message_string(item["message"]["S"]))
-
-        thread.sort(key=lambda x: x.ts, reverse=True)
+        while True:
+            response = dynamodb.query(**query)
+            thread.extend(Email.from_dynamodb_item(item) for item in response["Items"])
 
-        return thread
-
-    def as_dynamodb_item(self):
-        parsed_email = self.as_message()
+            if "LastEvaluatedKey" not in response:
+                return thread
+            query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
 
+    def as_dynamodb_item(self, send_after: int = None):
         item = {
             "sender": {"S": self.sender.email},
             "sender_name": {"S": self.sender.name},
@@ -327,23 +442,45 @@ class Email:
             "recipient_name": {"S": self.recipient.name},
             "id": {"S": self.get_message_id()},
             "subject": {"S": self.subject},
-            "message": {"S": parsed_email.as_string()},
+            "conversation": {"S": self.conversation_id()},
             "sent": {"S": str(self.sent)},
             "ts": {"N": str(int(time.time()))},
         }
 
+        if send_after:
+            # only deferred emails carry send_after, which keeps SendIndex sparse
+            item["send_after"] = {"N": str(int(send_after))}
+
+        message = self.as_string()
+        if len(message) > INLINE_MESSAGE_LIMIT:
+            item["message_key"] = {"S": blob_store().put(message.encode("utf-8"))}
+        else:
+            item["message"] = {"S": message}
+
+        if self.references:
+            item["references"] = {"L": [{"S": ref} for ref in self.references]}
+
+        if self.attachments:
+            item["attachments"] = {
+                "L": [attachment.as_dynamodb_value() for attachment in self.attachments]
+            }
+
         return item
 
-    def write(self):
-        dynamodb_client = boto3.client("dynamodb")
+    def write(self, send_after: int = None, if_new: bool = False):
+        # if_new leaves an item that is already there alone, raising
+        # ConditionalCheckFailedException instead of overwriting it
+        dynamodb_client = aws_client("dynamodb")
+        condition = {"ConditionExpression": "attribute_not_exists(id)"}
         response = dynamodb_client.put_item(
             TableName=mail_table(),
-            Item=self.as_dynamodb_item(),
+            Item=self.as_dynamodb_item(send_after),
+            **(condition if if_new else {}),
         )
         return response
 
     def enqueue_for_send(self, after_ts=0):
-        sqs = boto3.client("sqs")
+        sqs = aws_client("sqs")
         logging.info(
             f"enqueuing reply to {self.recipient.email}: subject: {self.subject}, body: {self.body}"
         )
@@ -354,12 +491,63 @@ class Email:
         )
 
 
+def encode_envelope(email: Email, **extra) -> str:
+    message = email.as_string()
+    envelope = {
+        "v": WIRE_VERSION,
+        "id": email.get_message_id(),
+        "sender": [email.sender.name, email.sender.email],
+        "recipient": [email.recipient.name, email.recipient.email],
+        "subject": email.subject,
+        "references": email.references,
+        "sent": email.sent,
+        "ts": int(email.ts),
+        **extra,
+    }
+
+    if len(message) > WIRE_COMPRESS_THRESHOLD:
+        envelope["encoding"] = "zlib"
+        envelope["email"] = base64.b64encode(
+            zlib.compress(message.encode("utf-8"))
+        ).decode("ascii")
+    else:
+        envelope["email"] = message
+
+    return json.dumps(envelope)
+
+
+def decode_envelope(body: str, receipt_handle: str = None) -> tuple[Email, dict]:
+    envelope = json.loads(body)
+
+    # unversioned messages are the old {"email": ..., "send_after": ...} shape
+    if "v" not in envelope:
+        return Email.from_message_string(envelope["email"], receipt_handle), envelope
+
+    message = envelope.pop("email")
+    if envelope.get("encoding") == "zlib":
+        message = zlib.decompress(base64.b64decode(message)).decode("utf-8")
+
+    email = Email(
+        sender=Contact(*envelope["sender"]),
+        recipient=Contact(*envelope["recipient"]),
+        subject=envelope["subject"],
+        references=envelope["references"],
+        message_id=envelope["id"],
+        receipt_handle=receipt_handle,
+        ts=envelope["ts"],
+        raw=message,
+        sent=envelope["sent"],
+    )
+    email._serialized = message
+    return email, envelope
+
+
 @dataclass
 class IncomingMailMessage:
     email: Email
 
     def as_json(self):
-        return json.dumps({"email": self.email.as_message().as_string()})
+        return encode_envelope(self.email)
 
 
 @dataclass
@@ -367,7 +555,7 @@ class ClientReceiveMessage:
     email: Email
 
     def as_json(self):
-        return json.dumps({"email": self.email.as_message().as_string()})
+        return encode_envelope(self.email)
 
 
 @dataclass
@@ -376,35 +564,229 @@ class ClientReplyMessage:
     send_after: int = 0
 
     def as_json(self):
-        return json.dumps(
-            {
-                "email": self.email.as_message().as_string(),
-                "send_after": self.send_after,
-            }
-        )
+        return encode_envelope(self.email, send_after=self.send_after)
+
+
+def batch_backoff(attempt: int):
+    time.sleep(min(0.05 * 2**attempt, 2.0) * random.uniform(0.5, 1.0))
+
+
+def item_key(item: dict) -> tuple[str, str]:
+    return item["id"]["S"], item["sender"]["S"]
+
+
+def put_emails(items: dict, chunk: dict) -> list[Email]:
+    # one put_item per item, so a single bad item fails on its own rather
+    # than taking every other email in its batch down with it
+    dynamodb = aws_client("dynamodb")
+    failed = []
+    for key, item in items.items():
+        try:
+            dynamodb.put_item(TableName=mail_table(), Item=item)
+        except ClientError as e:
+            logging.warning(f"could not store {key[0]}: {e}")
+            failed.extend(chunk[key])
+    return failed
+
+
+def write_emails(emails: list[Email]) -> list[Email]:
+    # BatchWriteItem in chunks of 25, retrying unprocessed items; returns the
+    # emails that still could not be written
+    dynamodb = aws_client("dynamodb")
+    failed = []
+
+    for start in range(0, len(emails), DYNAMODB_BATCH_SIZE):
+        # a batch may not hold the same key twice, so emails sharing a key
+        # are written as one item and succeed or fail together
+        chunk = {}
+        items = {}
+        for email in emails[start : start + DYNAMODB_BATCH_SIZE]:
+            # building the item is where a lazily parsed email is parsed, so a
+            # malformed one fails on its own instead of taking the batch down
+            try:
+                item = email.as_dynamodb_item()
+            except Exception as e:
+                logging.warning(f"could not store {email.get_message_id()}: {e}")
+                failed.append(email)
+                continue
+            chunk.setdefault(item_key(item), []).append(email)
+            items[item_key(item)] = item
+
+        requests = [{"PutRequest": {"Item": item}} for item in items.values()]
+        for attempt in range(MAX_BATCH_ATTEMPTS):
+            if not requests:
+                break
+
+            try:
+                response = dynamodb.batch_write_item(
+                    RequestItems={mail_table(): requests}
+                )
+                requests = response.get("UnprocessedItems", {}).get(mail_table(), [])
+            except ClientError as e:
+                logging.warning(f"batch write attempt {attempt + 1} failed: {e}")
+                if e.response["Error"]["Code"] not in RETRYABLE_ERRORS:
+                    # the batch is rejected as a whole, and would be again
+                    remaining = [item_key(r["PutRequest"]["Item"]) for r in requests]
+                    failed.extend(
+                        put_emails({key: items[key] for key in remaining}, chunk)
+                    )
+                    requests = []
+                    break
+
+            if requests:
+                batch_backoff(attempt)
+
+        for request in requests:
+            failed.extend(chunk[item_key(request["PutRequest"]["Item"])])
+
+    return failed
+
+
+def sqs_batches(entries: list[dict]) -> list[list[dict]]:
+    batches, batch, size = [], [], 0
+    for entry in entries:
+        entry_size = len(entry["MessageBody"].encode("utf-8"))
+        if batch and (
+            len(batch) == SQS_BATCH_SIZE or size + entry_size > SQS_BATCH_BYTES
+        ):
+            batches.append(batch)
+            batch, size = [], 0
+        batch.append(entry)
+        size += entry_size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def enqueue_emails_for_client(emails: list[Email]) -> list[Email]:
+    # SendMessageBatch version of Email.enqueue_for_client; returns the emails
+    # that still could not be enqueued
+    sqs = aws_client("sqs")
+    entries = []
+    failed = []
+    for index, email in enumerate(emails):
+        try:
+            body = ClientReceiveMessage(email=email).as_json()
+        except Exception as e:
+            logging.warning(f"could not enqueue {email.get_message_id()}: {e}")
+            failed.append(email)
+            continue
+        entries.append({"Id": str(index), "MessageBody": body})
+
+    for batch in sqs_batches(entries):
+        for attempt in range(MAX_BATCH_ATTEMPTS):
+            try:
+                response = sqs.send_message_batch(
+                    QueueUrl=queue_url("client"), Entries=batch
+                )
+                retry = {
+                    failure["Id"]
+                    for failure in response.get("Failed", [])
+                    if not failure.get("SenderFault")
+                }
+                failed.extend(
+                    emails[int(failure["Id"])]
+                    for failure in response.get("Failed", [])
+                    if failure.get("SenderFault")
+                )
+                batch = [entry for entry in batch if entry["Id"] in retry]
+            except ClientError as e:
+                logging.warning(f"batch enqueue attempt {attempt + 1} failed: {e}")
+
+            if not batch:
+                break
+            batch_backoff(attempt)
+
+        failed.extend(emails[int(entry["Id"])] for entry in batch)
+
+    failed_ids = {id(email) for email in failed}
+    for email in emails:
+        if id(email) not in failed_ids:
+            logging.info(
+                f"enqueued email to {email.recipient.email}: subject: {email.subject}"
+            )
+
+    return failed
+
+
+def poll_for_email(max_messages: int = 10) -> list[Email]:
+    # one long poll; may come back empty
+    sqs = aws_client("sqs")
+    response = sqs.receive_message(
+        QueueUrl=queue_url("client"),
+        MaxNumberOfMessages=max_messages,
+        WaitTimeSeconds=20,
+    )
+
+    emails = []
+    for message in response.get("Messages", []):
+        email, _ = decode_envelope(message["Body"], message["ReceiptHandle"])
+        logging.info(f"email from {email.sender.email} to {email.recipient.email}")
+
+        emails.append(email)
+
+    return emails
 
 
 def wait_for_email() -> list[Email]:
-    sqs = boto3.client("sqs")
     logging.info("waiting for email")
 
     while True:
-        response = sqs.receive_message(
-            QueueUrl=queue_url("client"),
-            MaxNumberOfMessages=10,
-            WaitTimeSeconds=20,
-        )
+        emails = poll_for_email()
+        if emails:
+            return emails
 
-        messages = response.get("Messages", [])
-        emails = []
 
-        for message in messages:
-            receipt_handle = message["ReceiptHandle"]
-            body = json.loads(message["Body"])
-            email = Email.from_message_string(body["email"], receipt_handle)
-            logging.info(f"email from {email.sender.email} to {email.recipient.email}")
+def backfill_conversation_ids() -> int:
+    # one-off pass for items written before the conversation attribute existed,
+    # or before it was scoped to the sender and recipient; re-running it only
+    # touches items whose conversation is not what it should be
+    dynamodb = aws_client("dynamodb")
+    scan = dict(
+        TableName=mail_table(),
+        ProjectionExpression="#id, #sender, #recipient, #references, #message, "
+        "#conversation",
+        ExpressionAttributeNames={
+            "#id": "id",
+            "#sender": "sender",
+            "#recipient": "recipient",
+            "#references": "references",
+            "#message": "message",
+            "#conversation": "conversation",
+        },
+    )
+
+    updated = 0
+    while True:
+        response = dynamodb.scan(**scan)
+        for item in response["Items"]:
+            if "references" in item:
+                references = [ref["S"] for ref in item["references"]["L"]]
+            elif "message" in item:
+                references = normalize_references(
+                    parse_headers(item["message"]["S"])["References"]
+                )
+            else:
+                references = []
 
-            emails.append(email)
+            conversation = conversation_id(
+                references,
+                item["id"]["S"],
+                item["sender"]["S"],
+                item.get("recipient", {}).get("S", ""),
+            )
+            if item.get("conversation", {}).get("S") == conversation:
+                continue
+
+            dynamodb.update_item(
+                TableName=mail_table(),
+                Key={"id": item["id"], "sender": item["sender"]},
+                UpdateExpression="SET conversation = :conversation",
+                ExpressionAttributeValues={":conversation": {"S": conversation}},
+            )
+            updated += 1
 
-        if len(messages) > 0:
-            return emails
+        if "LastEvaluatedKey" not in response:
+            logging.info(f"backfilled conversation ids on {updated} items")
+            return updated
+        scan["ExclusiveStartKey"] = response["LastEvaluatedKey"]
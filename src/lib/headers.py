@@ -0,0 +1,130 @@
+import email.errors
+import email.header
+import email.parser
+import email.utils
+import functools
+import re
+from dataclasses import dataclass
+from email.message import EmailMessage
+from typing import Self
+
+# the same handful of scammer and persona addresses show up on nearly every
+# message, so parsed contacts are interned rather than rebuilt per header
+CONTACT_CACHE_SIZE = 4096
+
+# "Name <user@host>", "\"Name\" <user@host>" or a bare "user@host"
+ADDRESS = re.compile(r"^\"?([^\"<>@,]*?)\"?\s*<?([^<>@\s,]+@[^<>@\s,]+)>?$")
+MESSAGE_ID = re.compile(r"<([^<>\s]+)>")
+TRAILING_NEWLINES = re.compile(r"[\r\n]+$")
+ENCODED_WORD = re.compile(r"=\?[^?]+\?[bBqQ]\?")
+LINE_BREAK = re.compile(r"[\r\n]+")
+
+
+def decode_words(value) -> str:
+    # rfc 2047 "=?charset?b?...?=" words, as found in names and subjects
+    if value is None:
+        return ""
+    # long subjects are folded over several lines; unfold them first, a value
+    # with a line break in it can't be written back into a header
+    value = LINE_BREAK.sub("", str(value))
+    if not ENCODED_WORD.search(value):
+        return value
+    try:
+        return str(email.header.make_header(email.header.decode_header(value)))
+    except (email.errors.HeaderParseError, LookupError, UnicodeDecodeError):
+        return value
+
+
+@dataclass(frozen=True, slots=True)
+class Contact:
+    name: str
+    email: str
+
+    @classmethod
+    def from_header(self, header: str) -> Self:
+        return parse_contact(str(header) if header is not None else "")
+
+    def to_header(self) -> str:
+        if not self.name or self.name == self.email:
+            return self.email
+        return email.utils.formataddr((self.name, self.email))
+
+    def domain(self) -> str:
+        return self.email.partition("@")[2]
+
+
+@functools.lru_cache(maxsize=CONTACT_CACHE_SIZE)
+def parse_contact(header: str) -> Contact:
+    header = " ".join(header.split())
+
+    match = ADDRESS.match(header)
+    if match:
+        name, address = match.group(1).strip(), match.group(2)
+    else:
+        # groups, comments, quoted commas and address lists; take the first
+        # real address
+        addresses = [a for a in email.utils.getaddresses([header]) if "@" in a[1]]
+        name, address = addresses[0] if addresses else (header, "")
+
+    name = decode_words(name).strip()
+    return Contact(name or address, address)
+
+
+def clean_reference(ref: str) -> str:
+    return TRAILING_NEWLINES.sub("", ref)
+
+
+def extract_id(id_header: str) -> str:
+    match = MESSAGE_ID.search(id_header)
+    if match:
+        return match.group(1).strip()
+    return id_header.strip() or None
+
+
+def normalize_message_id(id_header) -> str:
+    if id_header is None:
+        return None
+    return extract_id(str(id_header))
+
+
+def normalize_references(references_header) -> list[str]:
+    if references_header is None:
+        return []
+    references_header = str(references_header)
+    ids = MESSAGE_ID.findall(references_header)
+    if ids:
+        return [f"<{id}>" for id in ids]
+    return [clean_reference(ref) for ref in references_header.split()]
+
+
+def conversation_id(references: list[str], message_id: str, *addresses: str) -> str:
+    # every reply carries the first message of the conversation at the head of
+    # its References, so that root identifies the thread from either side. The
+    # same message can reach two personas, each then has its own conversation
+    # with the scammer, so the root is scoped to the pair of addresses
+    root = extract_id(references[0]) if references else extract_id(message_id)
+    return "|".join([root, *sorted(address.lower() for address in addresses)])
+
+
+def reference_token(message_id: str) -> str:
+    message_id = clean_reference(message_id).strip()
+    if message_id.startswith("<"):
+        return message_id
+    return f"<{message_id}>"
+
+
+def header_block(raw):
+    # everything up to the first blank line; enough to read the headers without
+    # handing the whole mime body to the parser
+    nl = "\n" if isinstance(raw, str) else b"\n"
+    cr = "\r" if isinstance(raw, str) else b"\r"
+    ends = [i for i in (raw.find(nl + nl), raw.find(nl + cr + nl)) if i >= 0]
+    return raw[: min(ends) + 1] if ends else raw
+
+
+def parse_headers(raw) -> EmailMessage:
+    # only the header block is decoded; the bytes parser would read raw 8-bit
+    # utf-8 names and subjects as ascii and garble them
+    if isinstance(raw, bytes):
+        raw = header_block(raw).decode("utf-8", "replace")
+    return email.parser.HeaderParser().parsestr(header_block(raw))
@@ -0,0 +1,113 @@
+from html.parser import HTMLParser
+
+# stop extracting once this much text has been produced; the opening of a mail
+# is all the reply generation ever looks at
+HTML_TEXT_MAX_CHARS = 32 * 1024
+
+# html is fed to the parser in chunks so a huge newsletter can be abandoned as
+# soon as the output is full instead of being tokenised to the end
+FEED_CHUNK_CHARS = 16 * 1024
+
+SKIP_TAGS = {"style", "script", "noscript", "template", "svg"}
+LINE_TAGS = {"br", "tr", "li", "dt", "dd"}
+PARAGRAPH_TAGS = {
+    "p",
+    "div",
+    "table",
+    "ul",
+    "ol",
+    "dl",
+    "blockquote",
+    "pre",
+    "hr",
+    "h1",
+    "h2",
+    "h3",
+    "h4",
+    "h5",
+    "h6",
+    "section",
+    "article",
+    "header",
+    "footer",
+}
+CELL_TAGS = {"td", "th"}
+
+
+class TextExtractor(HTMLParser):
+    def __init__(self, max_chars: int = HTML_TEXT_MAX_CHARS):
+        super().__init__(convert_charrefs=True)
+        self.max_chars = max_chars
+        self.parts = []
+        self.length = 0
+        self.skip_depth = 0
+        self.pending_break = ""
+        self.pending_space = False
+        self.full = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag == "br":
+            self.pending_break = (self.pending_break + "\n")[:2]
+        elif tag in LINE_TAGS:
+            self.pending_break = self.pending_break or "\n"
+        elif tag in PARAGRAPH_TAGS:
+            self.pending_break = "\n\n"
+        elif tag in CELL_TAGS:
+            self.pending_space = True
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            self.skip_depth = max(self.skip_depth - 1, 0)
+        elif tag in LINE_TAGS:
+            self.pending_break = self.pending_break or "\n"
+        elif tag in PARAGRAPH_TAGS:
+            self.pending_break = "\n\n"
+        elif tag in CELL_TAGS:
+            self.pending_space = True
+
+    def handle_data(self, data):
+        if self.skip_depth or self.full:
+            return
+
+        words = data.split()
+        if not words:
+            self.pending_space = self.pending_space or bool(data)
+            return
+
+        if not self.parts:
+            separator = ""
+        elif self.pending_break:
+            separator = self.pending_break
+        elif self.pending_space or data[0].isspace():
+            separator = " "
+        else:
+            separator = ""
+
+        text = separator + " ".join(words)
+        self.pending_break = ""
+        self.pending_space = data[-1].isspace()
+
+        if self.length + len(text) >= self.max_chars:
+            text = text[: self.max_chars - self.length]
+            self.full = True
+
+        self.parts.append(text)
+        self.length += len(text)
+
+    def text(self) -> str:
+        return "".join(self.parts).strip()
+
+
+def html_to_text(html: str, max_chars: int = HTML_TEXT_MAX_CHARS) -> str:
+    parser = TextExtractor(max_chars)
+
+    for start in range(0, len(html), FEED_CHUNK_CHARS):
+        parser.feed(html[start : start + FEED_CHUNK_CHARS])
+        if parser.full:
+            break
+    else:
+        parser.close()
+
+    return parser.text()
@@ -1,20 +1,132 @@
 import time
 import random
-import json
+import re
+from dataclasses import dataclass, fields, replace
+from typing import Self
 from termcolor import colored, cprint
 from ctransformers import AutoModelForCausalLM
+from huggingface_hub import hf_hub_download
+
+MODEL = "TheBloke/zephyr-7B-beta-GGUF"
+MODEL_FILE = "zephyr-7b-beta.{quantization}.gguf"
+QUANTIZATION = "Q4_K_M"
+CONTEXT_LENGTH = 8192
+MAX_NEW_TOKENS = 480
+# room for the example turn and the assistant tag that follow the history
+PROMPT_RESERVE = 64
+SUMMARY_MAX_TOKENS = 256
+# seconds a reply may take before we stop it and use what we have
+GENERATION_TIMEOUT = 90
+# the model carries on into made up turns unless it is stopped at the template markers
+STOP_SEQUENCES = ["</s>", "<|user|>", "<|system|>", "<|assistant|>"]
+# a sign-off followed by a name line is the end of the email
+SIGN_OFF = re.compile(
+    r"\n(best|best wishes|best regards|kind regards|warm regards|warmest regards|regards|"
+    r"sincerely|yours sincerely|yours truly|cheers|thanks|many thanks|thank you|god bless),?[ \t]*\n"
+    r"[^\n]+\n",
+    re.IGNORECASE,
+)
+
+
+class ChatSession:
+    # the history of one conversation, kept apart from the model so that any
+    # worker in the pool can pick it up
+    def __init__(self, root_prompt: str, user_prompt: str = "", summary: str = ""):
+        self.history = []
+        # token count of each history entry, None until the model has counted it
+        self.tokens = []
+
+        self.add_history("system", root_prompt)
+        if user_prompt != "":
+            self.add_history("system", user_prompt)
+        if summary != "":
+            self.add_history("system", f"Summary of the emails so far: {summary}")
+        # the system prompts are never dropped
+        self.pinned = len(self.history)
+
+    def add_history(self, user: str, prompt: str):
+        self.history.append(f"<|{user}|>\n{prompt}</s>\n")
+        self.tokens.append(None)
+
+    def count_tokens(self, tokenize) -> int:
+        for i, count in enumerate(self.tokens):
+            if count is None:
+                self.tokens[i] = len(tokenize(self.history[i]))
+        return sum(self.tokens)
+
+    def pack(self, budget: int) -> int:
+        # drop the oldest turns until the history fits, always keeping the
+        # system prompts and the newest turn
+        # todo: ask the ai to decide which should be removed?
+        total = sum(self.tokens)
+        while total > budget and len(self.history) > self.pinned + 1:
+            total -= self.tokens.pop(self.pinned)
+            del self.history[self.pinned]
+            print("deleted some history")
+        return total
+
+
+@dataclass
+class ModelConfig:
+    # which weights to run and how, the `model` section of config.yaml.
+    # cpu by default; the weights are mmap'd so every worker process on the
+    # host shares one copy through the page cache
+    repo: str = MODEL
+    file: str = MODEL_FILE
+    quantization: str = QUANTIZATION
+    path: str = None  # a local gguf file, skips the hub
+    model_type: str = None
+    context_length: int = CONTEXT_LENGTH
+    threads: int = None
+    batch_size: int = 8
+    gpu_layers: int = 0
+    mmap: bool = True
+    mlock: bool = False
+
+    @classmethod
+    def from_dict(cls, options: dict = None) -> Self:
+        names = {field.name for field in fields(cls)}
+        return cls(**{key: value for key, value in (options or {}).items() if key in names})
+
+    def filename(self) -> str:
+        return self.file.format(quantization=self.quantization)
+
+    def key(self) -> str:
+        return self.path or f"{self.repo}/{self.filename()}"
+
+    def resolve(self) -> Self:
+        # download once up front so the workers all open the same local file
+        # instead of racing each other to the hub
+        if self.path is not None:
+            return self
+        return replace(self, path=hf_hub_download(self.repo, self.filename()))
+
+    def load(self):
+        # https://github.com/marella/ctransformers#config
+        options = dict(context_length=self.context_length,
+                       batch_size=self.batch_size,
+                       gpu_layers=self.gpu_layers,
+                       mmap=self.mmap,
+                       mlock=self.mlock)
+        if self.threads is not None:
+            options['threads'] = self.threads
+        if self.model_type is not None:
+            options['model_type'] = self.model_type
+
+        if self.path is not None:
+            return AutoModelForCausalLM.from_pretrained(self.path, **options)
+        return AutoModelForCausalLM.from_pretrained(self.repo, model_file=self.filename(), **options)
 
 
 class LLMInterface:
-    def __init__(self, root_prompt: str = None):
-        #TheBloke/vicuna-7B-v1.3-GPTQ
-        self.llm = AutoModelForCausalLM.from_pretrained("TheBloke/zephyr-7B-beta-GGUF",
-                                                        #revision="gptq-4bit-32g-actorder_True",
-                                                        model_file="zephyr-7b-beta.Q4_K_M.gguf",
-                                                        context_length=8192,
-                                                        gpu_layers=999)
+    def __init__(self, root_prompt: str = None, model: ModelConfig = None, context_budget: int = None):
+        model = model or ModelConfig()
+        start_clock = time.time()
+        self.llm = model.load()
+        self.load_seconds = time.time() - start_clock
 
-        self.__max_history = 16
+        # tokens the history may use, the rest of the context is left for the reply
+        self.__context_budget = context_budget or model.context_length - MAX_NEW_TOKENS - PROMPT_RESERVE
 
         if root_prompt is not None:
             self.__root_prompt = root_prompt
@@ -33,62 +145,150 @@ class LLMInterface:
             "Talk about your grandchildren.",
             "Tell a story about your pet."
         ]
-        self.__history = []
+        self.__session = self.new_session()
+        # tokens of the last prompt, ctransformers keeps the matching prefix evaluated
+        self.__evaluated = []
+        self.last_stats = {}
 
-    def start_new_chat(self, user_prompt: str = ""):
-        # restart the session / clear the history
-        self.llm.reset()  # I assume this will work ??
-        # clear the history here
-        self.__history = []
+        self.warmup_seconds = self.warm_up()
+        print(f"Loaded {model.key()} in {round(self.load_seconds, 2)}s, "
+              f"warmed up in {round(self.warmup_seconds, 2)}s")
 
-        self.add_history("system", self.__root_prompt)
-        if user_prompt != "":
-            self.add_history("system", user_prompt)
+    def warm_up(self) -> float:
+        # pages the weights in and leaves the root prompt evaluated, so the
+        # first reply doesn't pay for either
+        start_clock = time.time()
+        prompt = self.new_session().history[0]
+        self.llm(prompt, max_new_tokens=1)
+        self.__evaluated = self.llm.tokenize(prompt)
+        return time.time() - start_clock
 
-    def parse_history(self, email_thread: str):
-        # try adding context here based on the names
-        cprint(f"Parsing email thread ({len(email_thread)})", "green", "on_grey")
-        json_thread = self.llm("<|system|>You are an email thread parsing ai. When given input, convert it to a json string in chat format with the sender and email body like this: {[{'Billy':'hello how are you'}, {'Frank':'i  am well thanks'}]}</s><|user|>\n```" + email_thread + "```</s>\n<|assistant|>",
-                               temperature=0.01)
-        cprint(json_thread, "yellow", "on_black")
-        data = json.loads(json_thread)
-        for user, email in enumerate(data):
-            cprint(user, "blue", "on_black")
-            cprint(email, "light_green", "on_black")
+    def summarize(self, summary: str, turns: list) -> str:
+        # fold new (speaker, text) turns into the running summary
+        # note this evaluates a different prompt, so the next reply starts cold
+        emails = "\n\n".join(f"{speaker}:\n{text}" for speaker, text in turns)
+        previous = f"Summary so far: {summary}\n\n" if summary else ""
+        prompt = ("<|system|>\nYou summarize email conversations. Keep names, amounts, "
+                  "websites, payment details, promises and questions still open. "
+                  "Answer with the updated summary only, in at most a few sentences.</s>\n"
+                  f"<|user|>\n{previous}New emails:\n{emails}</s>\n<|assistant|>")
+        self.__evaluated = []
+        summary, _ = self.generate(prompt, max_new_tokens=SUMMARY_MAX_TOKENS, temperature=0.2)
+        return summary
 
+    def new_session(self, user_prompt: str = "") -> ChatSession:
+        return ChatSession(self.__root_prompt, user_prompt)
 
-    def add_history(self, user: str, prompt: str):
-        self.__history.append(f"<|{user}|>\n{prompt}<|s>\n")
+    def start_new_chat(self, user_prompt: str = ""):
+        # restart the session / clear the history. the model isn't reset, the
+        # system prompt and personality are the same tokens every time so
+        # ctransformers picks up where the last prompt left off
+        self.__session = self.new_session(user_prompt)
 
-        if len(self.__history) > self.__max_history:
-            del self.__history[1]  # don't remove 0 because that is the main system prompt
-            print("deleted some history")
-        # todo: ask the ai to decide which should be removed?
-        # todo: base this on the number of tokens in the context not just the # of emails
+    def add_history(self, user: str, prompt: str):
+        self.__session.add_history(user, prompt)
 
-    def get_history(self):
+    def get_history(self, session: ChatSession = None):
         # todo: change this to be more dynamic and not hard-coded
-        # the first item in history is always the main system prompt. add example  text to it randomly...
-        history = self.__history
-        history[0] += " " + random.choice(self.__examples)
-        cprint(history[0], "green", "on_black")
-        return "".join(history)
+        # the random example goes last, anything in front of it has to stay the
+        # same between replies or the evaluated prefix can't be reused
+        example = random.choice(self.__examples)
+        cprint(example, "green", "on_black")
+        return "".join((session or self.__session).history) + f"<|system|>\n{example}</s>\n"
 
-    def respond_to(self, prompt: str, retry: bool = False) -> [str, str]:
+    def respond_to(self, prompt: str, retry: bool = False, session: ChatSession = None) -> [str, str]:
         start_clock = time.time()
+        session = session or self.__session
         # add the user input prompt to the history and return the response
-        self.add_history("user", prompt)
-        # https://github.com/marella/ctransformers#property-llmconfig
-        reply = self.llm(f"{self.get_history()}<|assistant|>",
-                         max_new_tokens=480, repetition_penalty=1.25, temperature=1.0)
+        session.count_tokens(self.llm.tokenize)
+        session.add_history("user", self.fit(prompt, self.__context_budget - sum(session.tokens[:session.pinned])))
+        session.count_tokens(self.llm.tokenize)
+        history_tokens = session.pack(self.__context_budget)
+
+        prompt = f"{self.get_history(session)}<|assistant|>"
+        tokens = self.llm.tokenize(prompt)
+        reused = self.prefix_length(tokens)
+
+        reply, stats = self.generate(prompt, max_new_tokens=MAX_NEW_TOKENS,
+                                     repetition_penalty=1.25, temperature=1.0,
+                                     sign_off=True, started=start_clock)
+        self.__evaluated = tokens
 
         # we should consider checking for toxic stuff / filtering this output
-        reply = self.purge(reply)
-        self.add_history("assistant", reply)
+        session.add_history("assistant", reply)
 
-        print(f"Processing time: {round(time.time() - start_clock, 2)}")
+        self.last_stats = {
+            **stats,
+            "prompt_tokens": len(tokens),
+            "reused_tokens": reused,
+            "history_tokens": history_tokens,
+            "history_entries": len(session.history),
+        }
+        print(f"Processing time: {round(time.time() - start_clock, 2)}, "
+              f"first token: {round(stats['ttft'], 2)}, "
+              f"{stats['new_tokens']} tokens at {round(stats['tokens_per_second'], 1)}/s "
+              f"({stats['stopped_by']}), "
+              f"reused {reused}/{len(tokens)} prompt tokens")
         return reply
 
+    def generate(self, prompt: str, sign_off: bool = False, started: float = None,
+                 timeout: float = GENERATION_TIMEOUT, **options) -> tuple[str, dict]:
+        # stream the reply so it can be cut off as soon as it is finished,
+        # ctransformers handles the stop sequences, we handle sign-offs and time
+        # https://github.com/marella/ctransformers#property-llmconfig
+        started = started or time.time()
+        first_token = None
+        stopped_by = "stop sequence or max tokens"
+        text = ""
+        new_tokens = 0
+        for chunk in self.llm(prompt, stream=True, stop=STOP_SEQUENCES, **options):
+            now = time.time()
+            if first_token is None:
+                first_token = now
+            new_tokens += 1
+            text += chunk
+
+            if sign_off and "\n" in chunk:
+                # only the last few lines can hold a sign-off that just finished
+                tail = len(text) - 200
+                match = SIGN_OFF.search(text, max(tail, 0))
+                if match:
+                    text = text[:match.end()]
+                    stopped_by = "sign-off"
+                    break
+            if now - started > timeout:
+                stopped_by = "timeout"
+                break
+
+        finished = time.time()
+        generating = finished - (first_token or finished)
+        return self.purge(text), {
+            "ttft": (first_token or finished) - started,
+            "new_tokens": new_tokens,
+            "tokens_per_second": new_tokens / generating if generating > 0 else 0.0,
+            "stopped_by": stopped_by,
+        }
+
+    def fit(self, text: str, limit: int) -> str:
+        # one email that won't fit on its own is cut short rather than
+        # pushing the system prompt out
+        tokens = self.llm.tokenize(text)
+        if len(tokens) <= limit:
+            return text
+        print(f"truncated prompt from {len(tokens)} to {limit} tokens")
+        return self.llm.detokenize(tokens[:max(limit, 0)])
+
+    def prefix_length(self, tokens: list) -> int:
+        reused = 0
+        for evaluated, token in zip(self.__evaluated, tokens):
+            if evaluated != token:
+                break
+            reused += 1
+        return reused
+
     def purge(self, text: str) -> str:
+        # anything past a template marker the stop sequences didn't catch
+        for marker in STOP_SEQUENCES:
+            text = text.split(marker, 1)[0]
         return text.strip()
     # return text.replace("<|im_start|>", "").replace("<|im_end|>", "").replace("kitboga", "")
@@ -0,0 +1,244 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import replace
+
+from lib.llm_wrapper import ChatSession, LLMInterface, ModelConfig
+
+MAX_CONVERSATIONS = 256
+TTFT_WINDOW = 100
+
+# the model loaded in this worker process, set once by load_model
+model = None
+
+
+def load_model(options: dict):
+    global model
+    model = LLMInterface(**options)
+    logging.info(f"model loaded in worker {os.getpid()}")
+
+
+def ready() -> dict:
+    return {
+        "pid": os.getpid(),
+        "load_seconds": model.load_seconds,
+        "warmup_seconds": model.warmup_seconds,
+    }
+
+
+def summarize(summary: str, turns: list) -> str:
+    return model.summarize(summary, turns)
+
+
+def respond(session: ChatSession, prompt: str):
+    reply = model.respond_to(prompt, session=session)
+    return reply, model.last_stats
+
+
+def default_threads(workers: int) -> int:
+    # split the cores between workers instead of every worker grabbing them all
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+class ModelPool:
+    # one single-process executor per worker so each process loads the model
+    # exactly once and we decide which worker a request goes to.
+    #
+    # a worker keeps the prompt it last evaluated, so requests are sent back to
+    # the worker that already has their system prompt and personality loaded.
+    # with one prefix per worker, the least recently used one is evicted when
+    # a new persona needs a worker.
+    def __init__(
+        self,
+        root_prompt: str,
+        model: ModelConfig = None,
+        workers: int = 1,
+        context_budget: int = None,
+        max_conversations: int = MAX_CONVERSATIONS,
+    ):
+        context = multiprocessing.get_context("spawn")
+        model = model or ModelConfig()
+        model = replace(
+            model.resolve(), threads=model.threads or default_threads(workers)
+        )
+        options = {
+            "root_prompt": root_prompt,
+            "model": model,
+            "context_budget": context_budget,
+        }
+
+        self.model = model
+        self.root_prompt = root_prompt
+        self.max_conversations = max_conversations
+        self.context = context
+        self.options = options
+
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+        self.idle = set(range(workers))
+        self.prefix_owners = OrderedDict()
+        self.worker_prefixes = {}
+
+        self.conversation_locks = OrderedDict()
+        self.ttft = {True: deque(maxlen=TTFT_WINDOW), False: deque(maxlen=TTFT_WINDOW)}
+
+        # start every worker loading now rather than on its first request,
+        # they load side by side while the pipeline starts polling
+        self.started = time.time()
+        self.workers = [self.start_worker() for _ in range(workers)]
+
+    def start_worker(self) -> ProcessPoolExecutor:
+        worker = ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=self.context,
+            initializer=load_model,
+            initargs=(self.options,),
+        )
+        worker.submit(ready).add_done_callback(self.report_ready)
+        return worker
+
+    def replace_worker(self, worker: int, broken: ProcessPoolExecutor):
+        # a worker process that died, or never loaded the model, leaves its
+        # executor broken for good; start a fresh one in its slot. Whatever
+        # prefix it held went with the process
+        with self.lock:
+            if self.workers[worker] is broken:
+                self.workers[worker] = self.start_worker()
+            prefix = self.worker_prefixes.pop(worker, None)
+            if prefix is not None and self.prefix_owners.get(prefix) == worker:
+                del self.prefix_owners[prefix]
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def run(self, key: tuple, fn, *args) -> tuple:
+        # on the worker holding the prefix for key if it is free; a request
+        # that hits a broken worker is retried once on a replacement
+        for attempt in range(2):
+            worker, hit = self.checkout(key)
+            executor = self.workers[worker]
+            try:
+                return executor.submit(fn, *args).result(), worker, hit
+            except BrokenProcessPool as e:
+                logging.error(f"model worker {worker} died, replacing it: {e}")
+                self.replace_worker(worker, executor)
+                if attempt:
+                    raise
+            finally:
+                self.checkin(worker)
+
+    def report_ready(self, future: Future):
+        if future.exception() is not None:
+            logging.error(f"model worker failed to load: {future.exception()}")
+            return
+        stats = future.result()
+        logging.info(
+            f"worker {stats['pid']} ready {time.time() - self.started:.2f}s after start "
+            f"(load {stats['load_seconds']:.2f}s, warm-up {stats['warmup_seconds']:.2f}s)"
+        )
+
+    def prefix_key(self, personality: str) -> tuple:
+        return (self.model.key(), self.root_prompt, personality)
+
+    def session(
+        self, personality: str = "", summary: str = "", history: list = ()
+    ) -> ChatSession:
+        # built from the summary and the recent turns every time, both are
+        # stored so nothing is lost when a worker or the whole process restarts
+        session = ChatSession(self.root_prompt, personality, summary)
+        for role, text in history:
+            session.add_history(role, text)
+        return session
+
+    def conversation_lock(self, conversation: str) -> threading.Lock:
+        with self.lock:
+            lock = self.conversation_locks.setdefault(conversation, threading.Lock())
+            self.conversation_locks.move_to_end(conversation)
+            while len(self.conversation_locks) > self.max_conversations:
+                self.conversation_locks.popitem(last=False)
+            return lock
+
+    def checkout(self, key: tuple) -> tuple[int, bool]:
+        with self.available:
+            while not self.idle:
+                self.available.wait()
+
+            owner = self.prefix_owners.get(key)
+            hit = owner in self.idle
+            if hit:
+                worker = owner
+            else:
+                # an empty worker first, then the one holding the stalest prefix
+                order = {w: i for i, w in enumerate(self.prefix_owners.values())}
+                worker = min(self.idle, key=lambda w: order.get(w, -1))
+                evicted = self.worker_prefixes.get(worker)
+                if evicted is not None and self.prefix_owners.get(evicted) == worker:
+                    del self.prefix_owners[evicted]
+
+            self.idle.remove(worker)
+            self.worker_prefixes[worker] = key
+            self.prefix_owners[key] = worker
+            self.prefix_owners.move_to_end(key)
+            return worker, hit
+
+    def checkin(self, worker: int):
+        with self.available:
+            self.idle.add(worker)
+            self.available.notify()
+
+    def respond(
+        self,
+        conversation: str,
+        prompt: str,
+        personality: str = "",
+        history: list = (),
+        summary: str = "",
+    ) -> str:
+        # replies within one conversation stay in order, different
+        # conversations go to whichever worker is free
+        with self.conversation_lock(conversation):
+            session = self.session(personality, summary, history)
+
+            (reply, stats), worker, hit = self.run(
+                self.prefix_key(personality), respond, session, prompt
+            )
+
+            with self.lock:
+                self.ttft[hit].append(stats["ttft"])
+            averages = self.ttft_stats()
+            logging.info(
+                f"worker {worker} {'reused' if hit else 'loaded'} persona prefix, "
+                f"first token after {stats['ttft']:.2f}s, "
+                f"{stats['new_tokens']} tokens at {stats['tokens_per_second']:.1f}/s "
+                f"(stopped by {stats['stopped_by']}), "
+                f"prompt {stats['prompt_tokens']} tokens ({stats['reused_tokens']} cached, "
+                f"{stats['history_entries']} history entries), "
+                f"average {averages['hit'] or 0:.2f}s warm / {averages['miss'] or 0:.2f}s cold"
+            )
+            return reply
+
+    def summarize(self, summary: str, turns: list) -> str:
+        summary, _, _ = self.run(("summary",), summarize, summary, turns)
+        return summary
+
+    def ttft_stats(self) -> dict:
+        with self.lock:
+            return {
+                "hit": (
+                    sum(self.ttft[True]) / len(self.ttft[True])
+                    if self.ttft[True]
+                    else None
+                ),
+                "miss": (
+                    sum(self.ttft[False]) / len(self.ttft[False])
+                    if self.ttft[False]
+                    else None
+                ),
+            }
+
+    def close(self):
+        for worker in self.workers:
+            worker.shutdown(cancel_futures=True)
@@ -0,0 +1,85 @@
+import logging
+import os
+import threading
+import time
+from botocore.exceptions import ClientError
+from lib.aws import aws_client
+
+# ssm values (queue urls, table names, persona names and passwords) barely
+# ever change, so they are cached for a while rather than fetched per email
+PARAMETER_PREFIX = "/bogamail"
+PARAMETER_TTL = 15 * 60
+MISSING_TTL = 60
+
+parameter_cache = {}
+prefetched_at = None
+lock = threading.Lock()
+
+
+def prefetch_parameters(path: str = PARAMETER_PREFIX) -> int:
+    # one GetParametersByPath sweep at cold start instead of a GetParameter
+    # per name; roles without the by-path permission just fall back to that
+    global prefetched_at
+    with lock:
+        if prefetched_at is not None and time.time() - prefetched_at < PARAMETER_TTL:
+            return 0
+        prefetched_at = time.time()
+
+        ssm = aws_client("ssm")
+        expires = time.time() + PARAMETER_TTL
+        count = 0
+        try:
+            for page in ssm.get_paginator("get_parameters_by_path").paginate(
+                Path=path, Recursive=True, WithDecryption=True
+            ):
+                for parameter in page["Parameters"]:
+                    parameter_cache[parameter["Name"]] = (parameter["Value"], expires)
+                    count += 1
+        except ClientError as e:
+            logging.info(f"parameter prefetch of {path} failed: {e}")
+
+        return count
+
+
+def get_parameter(name: str) -> str:
+    # returns None for parameters that don't exist
+    cached = parameter_cache.get(name)
+    if cached is not None and cached[1] > time.time():
+        return cached[0]
+
+    if name.startswith(PARAMETER_PREFIX) and prefetch_parameters():
+        cached = parameter_cache.get(name)
+        if cached is not None and cached[1] > time.time():
+            return cached[0]
+
+    try:
+        parameter = aws_client("ssm").get_parameter(Name=name, WithDecryption=True)
+        value, ttl = parameter["Parameter"]["Value"], PARAMETER_TTL
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ParameterNotFound":
+            raise
+        value, ttl = None, MISSING_TTL
+
+    parameter_cache[name] = (value, time.time() + ttl)
+    return value
+
+
+def setting(env_name: str, parameter_name: str) -> str:
+    # environment first (the lambdas), then ssm (the worker); both cached
+    cached = parameter_cache.get(env_name)
+    if cached is not None and cached[1] > time.time():
+        return cached[0]
+
+    value = os.environ.get(env_name) or get_parameter(parameter_name)
+    parameter_cache[env_name] = (value, time.time() + PARAMETER_TTL)
+    return value
+
+
+def invalidate_parameters(name: str = None):
+    global prefetched_at
+    with lock:
+        if name is None:
+            parameter_cache.clear()
+            prefetched_at = None
+        else:
+            parameter_cache.pop(name, None)
@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import signal
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+# marks the end of the stream as it drains through the stages
+STOP = object()
+# the most sqs hands out per receive
+MAX_POLL_MESSAGES = 10
+
+
+class ThroughputMeter:
+    def __init__(self, window: float = 15 * 60):
+        self.window = window
+        self.started = time.time()
+        self.completed = deque()
+        self.total = 0
+
+    def mark(self):
+        now = time.time()
+        self.total += 1
+        self.completed.append(now)
+        while self.completed and self.completed[0] < now - self.window:
+            self.completed.popleft()
+
+    def per_minute(self) -> float:
+        span = min(self.window, time.time() - self.started)
+        return len(self.completed) * 60 / span if span > 0 else 0.0
+
+
+class ReplyPipeline:
+    # poll -> load thread -> generate -> send, each stage its own task joined by
+    # bounded queues; a full queue stops the stage before it, so nothing is
+    # pulled off sqs faster than the model can answer it. every email still
+    # counts against max_in_flight until it is sent or has failed, and a poll
+    # only asks for what is left of that, so nothing sits in the pipeline past
+    # its sqs visibility timeout
+    def __init__(
+        self,
+        poll: Callable,
+        load: Callable,
+        generate: Callable,
+        send: Callable,
+        generators: int = 1,
+        queue_size: int = 4,
+        max_in_flight: int = None,
+        report_every: float = 60,
+    ):
+        self.poll_fn = poll
+        self.load_fn = load
+        self.generate_fn = generate
+        self.send_fn = send
+        self.generators = generators
+        self.queue_size = queue_size
+        # a reply takes up to a minute and a half, two per generator is done
+        # well inside the five minute visibility timeout
+        self.max_in_flight = max_in_flight or 2 * generators
+        self.in_flight = 0
+        self.report_every = report_every
+        self.meter = ThroughputMeter()
+        self.failures = 0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        self.released = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+
+        self.received = asyncio.Queue(maxsize=self.queue_size)
+        self.loaded = asyncio.Queue(maxsize=self.queue_size)
+        self.replies = asyncio.Queue(maxsize=self.queue_size)
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.generators, thread_name_prefix="generate"
+        )
+
+        reporter = asyncio.create_task(self.report())
+        try:
+            await asyncio.gather(
+                self.poll(),
+                self.load(),
+                *(self.generate() for _ in range(self.generators)),
+                self.send(),
+            )
+        finally:
+            reporter.cancel()
+            self.executor.shutdown()
+            logging.info(f"pipeline stopped after {self.meter.total} replies")
+
+    def stop(self):
+        # finish what has been pulled off the queue, then exit; anything not
+        # yet replied to stays on sqs and is redelivered
+        if not self.stopping.is_set():
+            logging.info("stopping after the emails already in flight")
+            self.stopping.set()
+            self.released.set()
+
+    def done(self):
+        self.in_flight -= 1
+        self.released.set()
+
+    async def poll(self):
+        while not self.stopping.is_set():
+            free = self.max_in_flight - self.in_flight
+            if free <= 0:
+                self.released.clear()
+                await self.released.wait()
+                continue
+
+            try:
+                emails = await asyncio.to_thread(
+                    self.poll_fn, min(free, MAX_POLL_MESSAGES)
+                )
+            except Exception:
+                logging.exception("polling for email failed")
+                await asyncio.sleep(5)
+                continue
+
+            self.in_flight += len(emails)
+            for email in emails:
+                await self.received.put(email)
+
+        await self.received.put(STOP)
+
+    async def load(self):
+        while (email := await self.received.get()) is not STOP:
+            try:
+                thread = await asyncio.to_thread(self.load_fn, email)
+            except Exception:
+                logging.exception(f"loading thread for {email.get_message_id()} failed")
+                self.failures += 1
+                self.done()
+                continue
+            await self.loaded.put((email, thread))
+
+        for _ in range(self.generators):
+            await self.loaded.put(STOP)
+
+    async def generate(self):
+        loop = asyncio.get_running_loop()
+        while (item := await self.loaded.get()) is not STOP:
+            email, thread = item
+            try:
+                response = await loop.run_in_executor(
+                    self.executor, self.generate_fn, email, thread
+                )
+            except Exception:
+                logging.exception(
+                    f"generating reply to {email.get_message_id()} failed"
+                )
+                self.failures += 1
+                self.done()
+                continue
+            await self.replies.put((email, response))
+
+        await self.replies.put(STOP)
+
+    async def send(self):
+        remaining = self.generators
+        while remaining:
+            item = await self.replies.get()
+            if item is STOP:
+                remaining -= 1
+                continue
+
+            email, response = item
+            try:
+                await asyncio.to_thread(self.send_fn, email, response)
+                self.meter.mark()
+            except Exception:
+                logging.exception(f"sending reply to {email.get_message_id()} failed")
+                self.failures += 1
+            self.done()
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(self.report_every)
+            logging.info(
+                f"throughput {self.meter.per_minute():.2f} replies/min "
+                f"({self.meter.total} total, {self.failures} failed); "
+                f"{self.in_flight} in flight, queued "
+                f"received={self.received.qsize()} loaded={self.loaded.qsize()} "
+                f"replies={self.replies.qsize()}"
+            )
@@ -0,0 +1,166 @@
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from lib.thread_parser import strip_quoted
+
+# scam campaigns mail the same opener to every persona; once a persona has
+# answered one, the rest of the campaign gets that answer without a model call
+URL = re.compile(r"(https?://|www\.)\S+", re.IGNORECASE)
+ADDRESS = re.compile(r"\S+@\S+\.\w+")
+NUMBER = re.compile(r"\d[\d,.]*")
+NON_WORD = re.compile(r"[^\w<>]+")
+
+GREETINGS = ["Hello", "Hi", "Dear", "Greetings", "Good day"]
+GREETING = re.compile(r"^(hello|hi|dear|greetings|good day)\b", re.IGNORECASE)
+SIGN_OFFS = ["Best regards", "Kind regards", "Warm regards", "Sincerely", "Best wishes"]
+SIGN_OFF = re.compile(
+    r"^(best regards|kind regards|warm regards|regards|sincerely|best wishes|best)(,?)$",
+    re.IGNORECASE | re.MULTILINE,
+)
+# bodies with fewer words than this left after normalising (forwards, one-line
+# nudges like "did you get my mail?") would all share a handful of fingerprints,
+# so they are never looked up or stored
+MIN_FINGERPRINT_WORDS = 8
+
+
+def fingerprint(body: str) -> str:
+    """
+    The same hash for bodies that only differ in quoting, links, addresses,
+    amounts, case, punctuation or whitespace, or None if too little is left
+    to tell one email from another
+    """
+    text = strip_quoted(body).lower()
+    text = URL.sub(" <url> ", text)
+    text = ADDRESS.sub(" <address> ", text)
+    text = NUMBER.sub(" <number> ", text)
+    words = NON_WORD.sub(" ", text).split()
+    if len(words) < MIN_FINGERPRINT_WORDS:
+        return None
+    text = " ".join(words)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def vary(reply: str) -> str:
+    # a different greeting and sign-off so two personas' copies of a cached
+    # reply don't read word for word the same
+    reply = GREETING.sub(lambda m: random.choice(GREETINGS), reply, count=1)
+    return SIGN_OFF.sub(lambda m: random.choice(SIGN_OFFS) + m.group(2), reply, count=1)
+
+
+@dataclass
+class CachedReply:
+    reply: str
+    generation_seconds: float
+    stored_at: float = field(default_factory=time.time)
+
+
+class ReplyCache:
+    def __init__(
+        self,
+        path: str = None,
+        max_entries: int = 1024,
+        ttl: float = 7 * 24 * 60 * 60,
+        variation: bool = True,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.variation = variation
+        self.replies = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self.load()
+
+    @staticmethod
+    def key(body: str, personality: str, position: int) -> str:
+        # keyed on the personality rather than the mailbox, so every address
+        # a campaign reaches that shares one persona shares its answers too
+        body_fingerprint = fingerprint(body)
+        if body_fingerprint is None:
+            return None
+        persona = hashlib.sha256(personality.encode("utf-8")).hexdigest()[:16]
+        return f"{persona}:{position}:{body_fingerprint}"
+
+    def get(self, key: str) -> str:
+        if key is None:
+            return None
+        with self.lock:
+            cached = self.replies.get(key)
+            if cached is not None and time.time() - cached.stored_at > self.ttl:
+                del self.replies[key]
+                cached = None
+
+            if cached is None:
+                self.misses += 1
+                return None
+
+            self.replies.move_to_end(key)
+            self.hits += 1
+            self.saved_seconds += cached.generation_seconds
+
+        logging.info(
+            f"reply cache hit, {self.hit_rate():.0%} hit rate, "
+            f"{self.saved_seconds:.0f}s of generation saved"
+        )
+        return vary(cached.reply) if self.variation else cached.reply
+
+    def put(self, key: str, reply: str, generation_seconds: float):
+        if key is None:
+            return
+        with self.lock:
+            self.replies[key] = CachedReply(reply, generation_seconds)
+            self.replies.move_to_end(key)
+            while len(self.replies) > self.max_entries:
+                self.replies.popitem(last=False)
+        self.save()
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.replies),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hit_rate(),
+                "saved_seconds": self.saved_seconds,
+            }
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as file:
+                entries = json.load(file)
+        except (OSError, ValueError):
+            logging.exception(f"ignoring unreadable reply cache {self.path}")
+            return
+
+        now = time.time()
+        for key, entry in entries.items():
+            cached = CachedReply(**entry)
+            if now - cached.stored_at <= self.ttl:
+                self.replies[key] = cached
+        logging.info(f"loaded {len(self.replies)} cached replies from {self.path}")
+
+    def save(self):
+        if self.path is None:
+            return
+        # write then rename so a crash never leaves half a file behind
+        partial = f"{self.path}.{os.getpid()}.tmp"
+        with self.lock:
+            entries = {key: asdict(cached) for key, cached in self.replies.items()}
+            with open(partial, "w") as file:
+                json.dump(entries, file)
+            os.replace(partial, self.path)
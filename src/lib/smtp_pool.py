@@ -0,0 +1,126 @@
+import logging
+import os
+import smtplib
+import threading
+import time
+from dataclasses import dataclass, field
+from email.message import Message
+
+SMTP_HOST = os.environ.get("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.environ.get("SMTP_PORT", "587"))
+
+# gmail drops idle connections after a few minutes and limits how much one
+# session may send; retire sessions well before either
+MAX_MESSAGES_PER_SESSION = 50
+MAX_IDLE_SECONDS = 120
+
+
+@dataclass
+class SmtpSession:
+    server: smtplib.SMTP
+    sent: int = 0
+    last_used: float = field(default_factory=time.time)
+
+    def close(self):
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            self.server.close()
+
+
+class SmtpPool:
+    # authenticated sessions per sender account, reused across messages for
+    # the lifetime of the lambda container or worker process
+    def __init__(
+        self,
+        host: str = SMTP_HOST,
+        port: int = SMTP_PORT,
+        starttls: bool = True,
+        max_messages: int = MAX_MESSAGES_PER_SESSION,
+        max_idle: float = MAX_IDLE_SECONDS,
+    ):
+        self.host = host
+        self.port = port
+        self.starttls = starttls
+        self.max_messages = max_messages
+        self.max_idle = max_idle
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.connects = 0
+
+    def connect(self, account: str, password: str) -> SmtpSession:
+        server = smtplib.SMTP(self.host, self.port, timeout=30)
+        try:
+            if self.starttls:
+                server.starttls()
+            if password is not None:
+                server.login(account, password)
+        except Exception:
+            server.close()
+            raise
+        self.connects += 1
+        logging.info(f"opened smtp session for {account} ({self.connects} total)")
+        return SmtpSession(server)
+
+    def usable(self, session: SmtpSession) -> bool:
+        idle = time.time() - session.last_used
+        if session.sent >= self.max_messages or idle > self.max_idle:
+            return False
+        # a reused session is checked right before the message goes out, so a
+        # dropped one is found while nothing has been sent on it yet
+        try:
+            return session.server.rset()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def checkout(self, account: str) -> SmtpSession:
+        while True:
+            with self.lock:
+                sessions = self.idle.get(account)
+                if not sessions:
+                    return None
+                session = sessions.pop()
+            if self.usable(session):
+                return session
+            session.close()
+
+    def checkin(self, account: str, session: SmtpSession):
+        session.last_used = time.time()
+        with self.lock:
+            self.idle.setdefault(account, []).append(session)
+
+    def deliver(self, account: str, session: SmtpSession, message: Message):
+        try:
+            session.server.send_message(message)
+        except (
+            smtplib.SMTPRecipientsRefused,
+            smtplib.SMTPSenderRefused,
+            smtplib.SMTPDataError,
+        ):
+            # refused by the server, but the session itself is still good
+            self.checkin(account, session)
+            raise
+        except Exception:
+            session.close()
+            raise
+        session.sent += 1
+        self.checkin(account, session)
+
+    def send(self, account: str, password: str, message: Message):
+        # never resent here: a session that drops while the message is going
+        # out may have dropped after the server took it, and a second copy
+        # would go to the scammer
+        session = self.checkout(account)
+        if session is None:
+            session = self.connect(account, password)
+        return self.deliver(account, session, message)
+
+    def close(self):
+        with self.lock:
+            sessions = [s for idle in self.idle.values() for s in idle]
+            self.idle = {}
+        for session in sessions:
+            session.close()
+
+
+smtp_pool = SmtpPool()
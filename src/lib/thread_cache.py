@@ -0,0 +1,102 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from lib.email import Email
+
+
+@dataclass
+class CachedThread:
+    # newest first, the same order Email.thread() returns
+    emails: list[Email]
+    ids: set[str] = field(default_factory=set)
+    loaded_at: float = field(default_factory=time.time)
+
+    def __post_init__(self):
+        self.ids.update(email.get_message_id() for email in self.emails)
+
+    def add(self, email: Email) -> bool:
+        if email.get_message_id() in self.ids:
+            return False
+        self.ids.add(email.get_message_id())
+        self.emails.insert(0, email)
+        return True
+
+
+class ThreadCache:
+    # keeps recently active conversations in the worker so a new message only
+    # costs an append; dynamodb is read on a miss or once an entry is stale
+    def __init__(
+        self,
+        max_conversations: int = 256,
+        max_emails: int = 4096,
+        stale_after: float = 15 * 60,
+    ):
+        self.max_conversations = max_conversations
+        self.max_emails = max_emails
+        self.stale_after = stale_after
+        self.threads = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def thread(self, email: Email) -> list[Email]:
+        key = email.conversation_id()
+
+        with self.lock:
+            cached = self.threads.get(key)
+            if cached and time.time() - cached.loaded_at < self.stale_after:
+                self.hits += 1
+                if cached.add(email):
+                    self.size += 1
+                self.threads.move_to_end(key)
+                self.evict()
+                return list(cached.emails)
+            self.misses += 1
+
+        emails = email.thread()
+        loaded = CachedThread(emails)
+        if loaded.add(email):
+            # receive_handler writes before enqueueing, but don't rely on it
+            emails = loaded.emails
+
+        with self.lock:
+            previous = self.threads.pop(key, None)
+            if previous:
+                self.size -= len(previous.emails)
+            self.threads[key] = loaded
+            self.size += len(loaded.emails)
+            self.evict()
+
+        logging.info(
+            f"thread cache miss for {key}: loaded {len(emails)} emails "
+            f"({self.hits} hits / {self.misses} misses)"
+        )
+        return list(emails)
+
+    def add(self, email: Email):
+        # our own replies only reach dynamodb once they are sent, so record
+        # them here as soon as they are generated
+        key = email.conversation_id()
+        with self.lock:
+            cached = self.threads.get(key)
+            if cached and cached.add(email):
+                self.size += 1
+                self.evict()
+
+    def invalidate(self, conversation_id: str = None):
+        with self.lock:
+            if conversation_id is None:
+                self.threads.clear()
+                self.size = 0
+            elif conversation_id in self.threads:
+                self.size -= len(self.threads.pop(conversation_id).emails)
+
+    def evict(self):
+        while self.threads and (
+            len(self.threads) > self.max_conversations or self.size > self.max_emails
+        ):
+            _, cached = self.threads.popitem(last=False)
+            self.size -= len(cached.emails)
@@ -0,0 +1,117 @@
+import re
+from dataclasses import dataclass
+
+from lib.headers import Contact
+
+# "On Mon, 1 Jan 2024 at 10:00, Bob <bob@example.com> wrote:" and friends,
+# mail clients often wrap it over two lines; the colon is required, without it
+# "On reflection, this is what I wrote" reads as an attribution too
+ATTRIBUTION = re.compile(
+    r"^(on|le|am|el|il|op)\b.{0,300}\b(wrote|a écrit|schrieb|escribió|ha scritto|schreef)\s?:$",
+    re.IGNORECASE,
+)
+ATTRIBUTION_START = re.compile(r"^(on|le|am|el|il|op)\b", re.IGNORECASE)
+SEPARATOR = re.compile(
+    r"^(-{2,}\s*(original message|forwarded message|reply message)\s*-{2,}"
+    r"|begin forwarded message:?|_{20,})$",
+    re.IGNORECASE,
+)
+HEADER = re.compile(
+    r"^(from|sent|date|to|cc|subject|de|von|envoyé|gesendet)\s?:", re.IGNORECASE
+)
+SIGNATURE = re.compile(
+    r"^(--|-- |sent from my \w+.*|get outlook for \w+.*|sent from (yahoo|aol) mail.*)$",
+    re.IGNORECASE,
+)
+# lines after a "From:" line that have to look like headers to count as a block
+HEADER_BLOCK_LINES = 3
+
+
+@dataclass(frozen=True, slots=True)
+class Turn:
+    speaker: Contact
+    text: str
+    ts: float = 0
+
+
+def quoted_from(lines: list[str], i: int) -> bool:
+    line = lines[i].strip()
+    if SEPARATOR.match(line):
+        return True
+
+    if ATTRIBUTION_START.match(line):
+        if ATTRIBUTION.match(line):
+            return True
+        if i + 1 < len(lines) and ATTRIBUTION.match(f"{line} {lines[i + 1].strip()}"):
+            return True
+
+    # an outlook style "From: / Sent: / To:" block with no separator above it
+    if HEADER.match(line) and line.lower().startswith(("from", "de", "von")):
+        following = lines[i + 1 : i + 1 + HEADER_BLOCK_LINES]
+        return len(following) > 1 and all(
+            HEADER.match(f.strip()) for f in following[:2]
+        )
+
+    return False
+
+
+def new_text(lines: list[str]) -> str:
+    kept = []
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        if stripped.startswith(">"):
+            continue
+        if SIGNATURE.match(stripped) or quoted_from(lines, i):
+            break
+        kept.append(line.rstrip())
+
+    text = "\n".join(kept)
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+
+def quoted_text(lines: list[str]) -> str:
+    # skip the separator, attribution and header lines at the top and take the
+    # text they introduce, one quoting level down if it is ">" quoted
+    i = 0
+    while i < len(lines):
+        line = lines[i].strip()
+        if not line or SEPARATOR.match(line) or HEADER.match(line):
+            i += 1
+        elif ATTRIBUTION.match(line):
+            i += 1
+        elif ATTRIBUTION_START.match(line) and i + 1 < len(lines):
+            if not ATTRIBUTION.match(f"{line} {lines[i + 1].strip()}"):
+                break
+            i += 2
+        else:
+            break
+
+    lines = lines[i:]
+    if lines and lines[0].lstrip().startswith(">"):
+        lines = [re.sub(r"^\s*> ?", "", line) for line in lines]
+    return new_text(lines)
+
+
+def strip_quoted(body: str) -> str:
+    """
+    The new text of an email: everything before the quoted reply, forwarded
+    headers or signature, minus any ">" quoted lines in between. An email with
+    nothing above the quote, like a bare forward, gets the text it quotes
+    """
+    lines = body.splitlines()
+    return new_text(lines) or quoted_text(lines)
+
+
+def thread_turns(thread: list, exclude: str = None) -> list[Turn]:
+    """
+    Oldest first (speaker, text) turns for a thread from Email.thread(),
+    skipping the message with id `exclude` and emails with nothing new in them
+    """
+    turns = []
+    for email in reversed(thread):
+        if exclude is not None and email.get_message_id() == exclude:
+            continue
+        text = strip_quoted(email.body)
+        if text:
+            turns.append(Turn(email.sender, text, email.ts))
+    return turns
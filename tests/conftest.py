@@ -0,0 +1,105 @@
+import os
+import sys
+
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, SRC)
+
+
+def source_path(name: str) -> str:
+    return os.path.join(SRC, name)
+
+
+def data_path(*names: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", *names)
+
+
+def create_tables(dynamodb):
+    dynamodb.create_table(
+        TableName="mail",
+        KeySchema=[
+            {"AttributeName": "sender", "KeyType": "HASH"},
+            {"AttributeName": "id", "KeyType": "RANGE"},
+        ],
+        AttributeDefinitions=[
+            {"AttributeName": name, "AttributeType": kind}
+            for name, kind in [
+                ("sender", "S"),
+                ("id", "S"),
+                ("conversation", "S"),
+                ("ts", "N"),
+                ("sent", "S"),
+                ("send_after", "N"),
+            ]
+        ],
+        GlobalSecondaryIndexes=[
+            {
+                "IndexName": "ConversationIndex",
+                "KeySchema": [
+                    {"AttributeName": "conversation", "KeyType": "HASH"},
+                    {"AttributeName": "ts", "KeyType": "RANGE"},
+                ],
+                "Projection": {"ProjectionType": "ALL"},
+            },
+            {
+                "IndexName": "SendIndex",
+                "KeySchema": [
+                    {"AttributeName": "sent", "KeyType": "HASH"},
+                    {"AttributeName": "send_after", "KeyType": "RANGE"},
+                ],
+                "Projection": {"ProjectionType": "ALL"},
+            },
+        ],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    for table, key in (("dedup", "id"), ("data", "email")):
+        dynamodb.create_table(
+            TableName=table,
+            KeySchema=[{"AttributeName": key, "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": key, "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+
+
+@pytest.fixture
+def aws(monkeypatch, tmp_path):
+    # moto stands in for dynamodb, sqs and ssm; attachments go to a local dir
+    moto = pytest.importorskip("moto")
+    for name, value in {
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "AWS_ACCESS_KEY_ID": "testing",
+        "AWS_SECRET_ACCESS_KEY": "testing",
+        "MAIL_TABLE": "mail",
+        "DEDUP_TABLE": "dedup",
+        "DATA_TABLE": "data",
+        "BLOB_DIR": str(tmp_path / "blobs"),
+    }.items():
+        monkeypatch.setenv(name, value)
+
+    from lib import aws, blobs, dedup, params
+
+    with moto.mock_aws():
+        aws.session_cache = None
+        aws.client_cache.clear()
+        aws.resource_cache.clear()
+        blobs.blob_store_cache = None
+        dedup.recent_ids.clear()
+        params.invalidate_parameters()
+
+        create_tables(aws.aws_client("dynamodb"))
+        sqs = aws.aws_client("sqs")
+        for name in ("client", "send"):
+            url = sqs.create_queue(QueueName=name)["QueueUrl"]
+            monkeypatch.setenv(f"{name.upper()}_QUEUE_URL", url)
+
+        ssm = aws.aws_client("ssm")
+        ssm.put_parameter(
+            Name="/bogamail/names/frank56furter", Value="Frank", Type="String"
+        )
+        ssm.put_parameter(
+            Name="/bogamail/passwords/frank56furter",
+            Value="password",
+            Type="SecureString",
+        )
+        yield aws
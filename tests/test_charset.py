@@ -0,0 +1,25 @@
+import pytest
+
+
+@pytest.mark.parametrize("charset", ["base64", "hex", "rot13", "zlib"])
+def test_bytes_codecs_are_not_charsets(charset):
+    from lib.charset import known_charset
+
+    assert not known_charset(charset)
+
+
+@pytest.mark.parametrize("charset", ["base64", "hex", "rot13", "no-such-charset"])
+def test_unusable_declared_charset_falls_through(charset):
+    from lib.charset import decode_with_tier
+
+    assert decode_with_tier(b"hello there", charset) == ("hello there", "ascii")
+    assert decode_with_tier("héllo".encode("utf-8"), charset) == ("héllo", "utf-8")
+
+
+def test_declared_charset_is_used():
+    from lib.charset import decode_with_tier
+
+    assert decode_with_tier("héllo".encode("latin-1"), "latin-1") == (
+        "héllo",
+        "declared",
+    )
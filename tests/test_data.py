@@ -0,0 +1,21 @@
+def test_summaries_are_kept_per_conversation(aws):
+    from lib.data import get_scam_data, get_summary, store_summary
+
+    store_summary("scammer@example.com", "frank-thread", "asked for fees", 10)
+    store_summary("scammer@example.com", "susan-thread", "sent a cheque", 20)
+
+    assert get_summary("scammer@example.com", "frank-thread") == ("asked for fees", 10)
+    assert get_summary("scammer@example.com", "susan-thread") == ("sent a cheque", 20)
+    assert get_summary("scammer@example.com", "other-thread") == ("", 0)
+    assert get_scam_data("scammer@example.com") == {}
+
+
+def test_summaries_and_scam_data_do_not_overwrite_each_other(aws):
+    from lib.data import get_scam_data, get_summary, store_scam_data, store_summary
+
+    store_scam_data("scammer@example.com", {"name": "James"})
+    store_summary("scammer@example.com", "frank-thread", "asked for fees", 10.5)
+    store_scam_data("scammer@example.com", {"name": "James Okafor"})
+
+    assert get_scam_data("scammer@example.com") == {"name": "James Okafor"}
+    assert get_summary("scammer@example.com", "frank-thread") == ("asked for fees", 10.5)
@@ -0,0 +1,167 @@
+def test_item_without_a_message_id_header_keeps_its_id():
+    from lib.email import Email
+
+    # written by the old as_message(), which never set a Message-ID header
+    item = {
+        "id": {"S": "legacy@example.com"},
+        "sender": {"S": "scammer@example.com"},
+        "message": {
+            "S": "From: Scammer <scammer@example.com>\n"
+            "To: Frank <frank56furter@gmail.com>\n"
+            "Subject: hello\n"
+            "\n"
+            "hello\n"
+        },
+    }
+
+    assert Email.from_dynamodb_item(item).get_message_id() == "legacy@example.com"
+    assert Email.from_dynamodb_item(item).get_message_id() == "legacy@example.com"
+
+
+def test_folded_subject_is_unfolded():
+    from lib.email import Email
+
+    def parsed(subject: bytes) -> Email:
+        return Email.from_bytes(
+            b"From: Scammer <scammer@example.com>\r\n"
+            b"To: Frank <frank56furter@gmail.com>\r\n"
+            b"Subject: " + subject + b"\r\n"
+            b"\r\n"
+            b"hello\r\n"
+        )
+
+    plain = parsed(b"a very long subject line that\r\n is folded")
+    assert plain.subject == "a very long subject line that is folded"
+    assert "Subject: a very long subject line that is folded" in plain.as_string()
+
+    encoded = parsed(b"=?utf-8?q?folded_th=C3=A9?=\r\n =?utf-8?q?_lines?=")
+    assert encoded.subject == "folded thé lines"
+
+
+def test_conversation_is_scoped_to_the_persona():
+    from lib.email import Email
+
+    raw = (
+        b"From: Scammer <scammer@example.com>\r\n"
+        b"To: Frank <frank56furter@gmail.com>\r\n"
+        b"Message-ID: <root@example.com>\r\n"
+        b"Subject: hello\r\n"
+        b"\r\n"
+        b"hello\r\n"
+    )
+    frank = Email.from_bytes(raw)
+    susan = Email.from_bytes(raw.replace(b"frank56furter@", b"susan@"))
+    assert frank.conversation_id() != susan.conversation_id()
+
+    # our reply, as Email.reply builds it, stays in the same conversation
+    reply = Email(
+        frank.recipient,
+        frank.sender,
+        "RE: hello",
+        body="Hello there",
+        references=["<root@example.com>"],
+    )
+    assert reply.conversation_id() == frank.conversation_id()
+
+
+def envelope_email(body: str):
+    from lib.email import Email
+    from lib.headers import Contact
+
+    return Email(
+        Contact("Frank", "frank56furter@gmail.com"),
+        Contact("Scammer", "scammer@example.com"),
+        "RE: hello",
+        body=body,
+        references=["<root@example.com>"],
+    )
+
+
+def test_unversioned_envelope_still_decodes():
+    import json
+
+    from lib.email import decode_envelope
+
+    message = envelope_email("Hello there").as_message()
+    body = json.dumps({"email": message.as_string(), "send_after": 5})
+
+    email, envelope = decode_envelope(body, "handle")
+    assert email.sender.email == "frank56furter@gmail.com"
+    assert email.references == ["<root@example.com>"]
+    assert email.receipt_handle == "handle"
+    assert envelope["send_after"] == 5
+
+
+def test_large_envelope_is_compressed_and_round_trips():
+    import json
+
+    from lib.email import (
+        WIRE_COMPRESS_THRESHOLD,
+        ClientReplyMessage,
+        decode_envelope,
+    )
+
+    original = envelope_email("Please send the fee.\n" * WIRE_COMPRESS_THRESHOLD)
+    body = ClientReplyMessage(email=original, send_after=5).as_json()
+    assert json.loads(body)["encoding"] == "zlib"
+    assert len(body) < len(original.as_string())
+
+    email, envelope = decode_envelope(body)
+    assert email.get_message_id() == original.get_message_id()
+    assert email.references == original.references
+    assert email.as_string() == original.as_string()
+    assert email.body.startswith("Please send the fee.")
+    assert envelope["send_after"] == 5
+
+
+def test_thread_follows_every_page(aws, monkeypatch):
+    from lib import email as lib_email
+
+    root = envelope_email("first")
+    root.write()
+    for n in range(4):
+        envelope_email(f"reply {n}").write()
+
+    dynamodb = aws.aws_client("dynamodb")
+    pages = []
+
+    class Paged:
+        def query(self, **kwargs):
+            pages.append(kwargs.get("ExclusiveStartKey"))
+            return dynamodb.query(Limit=2, **kwargs)
+
+    monkeypatch.setattr(lib_email, "aws_client", lambda name: Paged())
+    assert len(root.thread()) == 5
+    assert len(pages) == 3
+
+
+def test_backfill_is_idempotent(aws):
+    from lib.email import backfill_conversation_ids
+
+    emails = [envelope_email(f"reply {n}") for n in range(3)]
+    for email in emails:
+        email.write()
+
+    dynamodb = aws.aws_client("dynamodb")
+    key = {
+        "id": {"S": emails[0].get_message_id()},
+        "sender": {"S": "frank56furter@gmail.com"},
+    }
+    # written before the attribute existed, and before it was scoped
+    dynamodb.update_item(
+        TableName="mail", Key=key, UpdateExpression="REMOVE conversation"
+    )
+    key["id"]["S"] = emails[1].get_message_id()
+    dynamodb.update_item(
+        TableName="mail",
+        Key=key,
+        UpdateExpression="SET conversation = :root",
+        ExpressionAttributeValues={":root": {"S": "root@example.com"}},
+    )
+
+    assert backfill_conversation_ids() == 2
+    assert backfill_conversation_ids() == 0
+    items = dynamodb.scan(TableName="mail")["Items"]
+    assert {item["conversation"]["S"] for item in items} == {
+        emails[2].conversation_id()
+    }
@@ -0,0 +1,65 @@
+import glob
+import os
+
+import pytest
+from conftest import data_path
+
+CORPUS = sorted(glob.glob(data_path("html", "*.html")))
+
+
+def read(path: str) -> str:
+    with open(path, encoding="utf-8") as file:
+        return file.read()
+
+
+def squashed(text: str) -> str:
+    # parity is on the text itself, bs4 doesn't lay out lines and paragraphs
+    return "".join(text.split())
+
+
+@pytest.mark.parametrize("path", CORPUS, ids=os.path.basename)
+def test_same_text_as_beautifulsoup(path):
+    bs4 = pytest.importorskip("bs4")
+    from lib.html_text import SKIP_TAGS, html_to_text
+
+    html = read(path)
+    soup = bs4.BeautifulSoup(html, "html.parser")
+    for tag in soup(list(SKIP_TAGS)):
+        tag.decompose()
+
+    assert squashed(html_to_text(html)) == squashed(soup.get_text())
+
+
+def test_lines_and_paragraphs_are_kept():
+    from lib.html_text import html_to_text
+
+    text = html_to_text(read(data_path("html", "invoice.html")))
+    assert text.startswith(
+        "Invoice #INV-20931\n"
+        "\n"
+        "Thank you for your order. Your subscription renews today.\n"
+        "\n"
+        "Item Qty Price\n"
+        "Norton Total Security 1 $399.99\n"
+    )
+
+
+def test_output_is_bounded():
+    from lib.html_text import html_to_text
+
+    html = read(data_path("html", "newsletter.html")) * 1000
+    assert len(html_to_text(html, max_chars=1024)) <= 1024
+
+
+def test_html_only_message_body_is_text():
+    import email
+
+    from lib.email import get_plain_text_body
+
+    message = email.message_from_bytes(
+        b"From: Scam <scam@example.com>\r\n"
+        b"Content-Type: text/html; charset=utf-8\r\n"
+        b"\r\n"
+        b"<html><style>p{}</style><p>Hello friend</p></html>\r\n"
+    )
+    assert get_plain_text_body(message) == "Hello friend"
@@ -0,0 +1,42 @@
+import pytest
+
+pytest.importorskip("ctransformers")
+
+
+def tokenize(text: str) -> list[str]:
+    return text.split()
+
+
+def session(turns: int):
+    from lib.llm_wrapper import ChatSession
+
+    chat = ChatSession("You answer scam emails.", "You are Frank.", "They want fees.")
+    for n in range(turns):
+        chat.add_history("user" if n % 2 else "assistant", f"turn {n} " + "word " * 20)
+    return chat
+
+
+def test_pack_drops_the_oldest_turns_to_fit():
+    chat = session(6)
+    pinned = chat.history[: chat.pinned]
+    newest = chat.history[-1]
+    total = chat.count_tokens(tokenize)
+
+    budget = total - 30
+    packed = chat.pack(budget)
+    assert packed <= budget
+    assert packed == sum(chat.tokens) == chat.count_tokens(tokenize)
+    assert chat.history[: chat.pinned] == pinned
+    assert chat.history[-1] == newest
+    # only the oldest turns went, the rest are kept in order
+    assert "turn 2 " in chat.history[chat.pinned]
+
+
+def test_pack_keeps_the_pinned_prompts_and_newest_turn_over_budget():
+    chat = session(4)
+    pinned = chat.history[: chat.pinned]
+    newest = chat.history[-1]
+    chat.count_tokens(tokenize)
+
+    chat.pack(1)
+    assert chat.history == pinned + [newest]
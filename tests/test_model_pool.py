@@ -0,0 +1,58 @@
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+pytest.importorskip("ctransformers")
+
+
+class Worker:
+    # stands in for a one-process executor, running the call inline
+    def __init__(self, broken: bool):
+        self.broken = broken
+
+    def submit(self, fn, *args):
+        future = Future()
+        if self.broken:
+            future.set_exception(BrokenProcessPool("worker died"))
+        else:
+            future.set_result(("reply", {}) if fn.__name__ == "respond" else "summary")
+        return future
+
+    def shutdown(self, **kwargs):
+        pass
+
+
+def pool(monkeypatch, broken: list[bool]):
+    from lib.llm_wrapper import ModelConfig
+    from lib.model_pool import ModelPool
+
+    started = []
+
+    def start_worker(self):
+        started.append(Worker(broken[len(started)]))
+        return started[-1]
+
+    monkeypatch.setattr(ModelPool, "start_worker", start_worker)
+    return ModelPool("prompt", ModelConfig(path="model.gguf")), started
+
+
+def test_dead_worker_is_replaced_and_the_request_retried(monkeypatch):
+    models, started = pool(monkeypatch, [True, False])
+    models.worker_prefixes[0] = models.prefix_key("Frank")
+    models.prefix_owners[models.prefix_key("Frank")] = 0
+
+    assert models.summarize("", []) == "summary"
+    assert len(started) == 2
+    assert models.workers == [started[1]]
+    assert models.prefix_key("Frank") not in models.prefix_owners
+    assert models.idle == {0}
+
+
+def test_request_fails_if_the_replacement_dies_too(monkeypatch):
+    models, started = pool(monkeypatch, [True, True, False])
+
+    with pytest.raises(BrokenProcessPool):
+        models.summarize("", [])
+    assert models.workers == [started[2]]
+    assert models.idle == {0}
@@ -0,0 +1,79 @@
+def ssm_calls(aws, monkeypatch) -> list[str]:
+    # counts the GetParameter calls that reach ssm; prefetch is denied, as for
+    # a role without the by-path permission
+    from botocore.exceptions import ClientError
+    from lib import params
+
+    ssm = aws.aws_client("ssm")
+    calls = []
+
+    class Counted:
+        def get_parameter(self, **kwargs):
+            calls.append(kwargs["Name"])
+            return ssm.get_parameter(**kwargs)
+
+        def get_paginator(self, name):
+            raise ClientError(
+                {"Error": {"Code": "AccessDeniedException", "Message": "denied"}},
+                "GetParametersByPath",
+            )
+
+    monkeypatch.setattr(params, "aws_client", lambda name: Counted())
+    return calls
+
+
+def test_parameter_is_cached_until_its_ttl(aws, monkeypatch):
+    from lib import params
+
+    calls = ssm_calls(aws, monkeypatch)
+    name = "/bogamail/names/frank56furter"
+    assert params.get_parameter(name) == "Frank"
+    assert params.get_parameter(name) == "Frank"
+    assert calls == [name]
+
+    later = params.time.time() + params.PARAMETER_TTL + 1
+    monkeypatch.setattr(params.time, "time", lambda: later)
+    assert params.get_parameter(name) == "Frank"
+    assert calls == [name, name]
+
+
+def test_missing_parameter_is_cached_briefly(aws, monkeypatch):
+    from lib import params
+
+    calls = ssm_calls(aws, monkeypatch)
+    name = "/bogamail/names/susan"
+    assert params.get_parameter(name) is None
+    assert params.get_parameter(name) is None
+    assert calls == [name]
+
+    # created since; seen once the shorter negative ttl runs out
+    aws.aws_client("ssm").put_parameter(Name=name, Value="Susan", Type="String")
+    later = params.time.time() + params.MISSING_TTL + 1
+    monkeypatch.setattr(params.time, "time", lambda: later)
+    assert params.get_parameter(name) == "Susan"
+
+
+def test_invalidate_drops_cached_values(aws, monkeypatch):
+    from lib import params
+
+    calls = ssm_calls(aws, monkeypatch)
+    name = "/bogamail/names/frank56furter"
+    params.get_parameter(name)
+    aws.aws_client("ssm").put_parameter(
+        Name=name, Value="Francis", Type="String", Overwrite=True
+    )
+    assert params.get_parameter(name) == "Frank"
+
+    params.invalidate_parameters(name)
+    assert params.get_parameter(name) == "Francis"
+    params.invalidate_parameters()
+    assert params.get_parameter(name) == "Francis"
+    assert calls == [name, name, name]
+
+
+def test_prefetch_fills_the_cache_in_one_sweep(aws, monkeypatch):
+    from lib import params
+
+    assert params.prefetch_parameters() == 2
+    monkeypatch.setattr(params, "aws_client", None)
+    assert params.get_parameter("/bogamail/passwords/frank56furter") == "password"
@@ -0,0 +1,76 @@
+import asyncio
+import threading
+import time
+
+
+class Email:
+    def __init__(self, number: int):
+        self.number = number
+
+    def get_message_id(self) -> str:
+        return str(self.number)
+
+
+def run(total: int, fail: set = frozenset(), **kwargs):
+    from lib.pipeline import ReplyPipeline
+
+    requested = []
+    peak = 0
+    sent = []
+    lock = threading.Lock()
+
+    def poll(max_messages):
+        nonlocal peak
+        with lock:
+            requested.append(max_messages)
+            start = sum(len(batch) for batch in polled)
+            batch = [Email(n) for n in range(start, min(start + max_messages, total))]
+            polled.append(batch)
+            peak = max(peak, pipeline.in_flight + len(batch))
+        if not batch:
+            loop.call_soon_threadsafe(pipeline.stop)
+            time.sleep(0.01)
+        return batch
+
+    def generate(email, thread):
+        time.sleep(0.01)
+        if email.number in fail:
+            raise RuntimeError("model failed")
+        return f"reply to {email.number}"
+
+    polled = []
+    pipeline = ReplyPipeline(
+        poll=poll,
+        load=lambda email: [],
+        generate=generate,
+        send=lambda email, response: sent.append(response),
+        **kwargs,
+    )
+
+    async def main():
+        nonlocal loop
+        loop = asyncio.get_running_loop()
+        await pipeline.run()
+
+    loop = None
+    asyncio.run(main())
+    return pipeline, requested, peak, sent
+
+
+def test_polls_only_for_free_capacity():
+    pipeline, requested, peak, sent = run(25, generators=2, max_in_flight=5)
+
+    assert len(sent) == 25
+    assert peak <= 5
+    assert requested[0] == 5
+    assert all(1 <= n <= 5 for n in requested)
+    assert pipeline.in_flight == 0
+
+
+def test_failures_free_their_place():
+    pipeline, requested, peak, sent = run(12, fail={1, 2, 3}, max_in_flight=3)
+
+    assert len(sent) == 9
+    assert pipeline.failures == 3
+    assert peak <= 3
+    assert pipeline.in_flight == 0
@@ -0,0 +1,223 @@
+import base64
+import json
+import time
+
+import pytest
+from conftest import source_path
+
+
+def ses_event():
+    with open(source_path("test_receive_event.json")) as file:
+        return json.load(file)
+
+
+def record(message_id: str, ses_message: dict) -> dict:
+    return {
+        "messageId": message_id,
+        "body": json.dumps({"Message": json.dumps(ses_message)}),
+    }
+
+
+def count(aws, table: str) -> int:
+    return aws.aws_client("dynamodb").scan(TableName=table)["Count"]
+
+
+def test_redelivery_is_dropped_once_stored(aws):
+    import lambda_handler
+
+    event = {"Records": [record("r1", ses_event())]}
+    assert lambda_handler.receive_handler(event, None)["batchItemFailures"] == []
+    assert lambda_handler.receive_handler(event, None)["batchItemFailures"] == []
+    assert count(aws, "mail") == 1
+
+
+def test_claims_are_released_when_the_handler_raises(aws, monkeypatch):
+    import lambda_handler
+
+    event = {"Records": [record("r1", ses_event())]}
+
+    def unavailable(emails):
+        raise RuntimeError("sqs unavailable")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(lambda_handler, "enqueue_emails_for_client", unavailable)
+        with pytest.raises(RuntimeError):
+            lambda_handler.receive_handler(event, None)
+    assert count(aws, "dedup") == 0
+
+    assert lambda_handler.receive_handler(event, None)["batchItemFailures"] == []
+    assert count(aws, "mail") == 1
+
+
+def test_expired_lease_is_claimed_again(aws):
+    import lambda_handler
+    from lib.dedup import PENDING
+
+    ses_message = ses_event()
+    raw = lambda_handler.ses_content_bytes(ses_message)
+    email = lambda_handler.received_email(ses_message, raw)
+    key = lambda_handler.delivery_key(ses_message, raw, email)
+    # left behind by an invocation that timed out
+    aws.aws_client("dynamodb").put_item(
+        TableName="dedup",
+        Item={
+            "id": {"S": key},
+            "status": {"S": PENDING},
+            "lease_until": {"N": str(int(time.time()) - 1)},
+        },
+    )
+
+    event = {"Records": [record("r1", ses_message)]}
+    assert lambda_handler.receive_handler(event, None)["batchItemFailures"] == []
+    assert count(aws, "mail") == 1
+
+
+def raw_event(message_id: str, raw: bytes) -> dict:
+    ses_message = ses_event()
+    ses_message["content"] = base64.b64encode(raw).decode("ascii")
+    ses_message["mail"] = dict(ses_message["mail"], messageId=message_id)
+    return ses_message
+
+
+def test_email_that_fails_to_store_is_reported_on_its_own(aws, monkeypatch):
+    import lambda_handler
+    from lib.email import Email
+
+    as_dynamodb_item = Email.as_dynamodb_item
+
+    def fail_on_broken(email, *args, **kwargs):
+        if email.subject == "broken":
+            raise ValueError("cannot parse body")
+        return as_dynamodb_item(email, *args, **kwargs)
+
+    monkeypatch.setattr(Email, "as_dynamodb_item", fail_on_broken)
+    broken = (
+        b"From: Scam <scam@example.com>\r\nTo: Frank <frank56furter@gmail.com>\r\n"
+        b"Message-ID: <broken@example.com>\r\nSubject: broken\r\n\r\nhello\r\n"
+    )
+    event = {
+        "Records": [
+            record("r1", ses_event()),
+            record("r2", raw_event("m2", broken)),
+        ]
+    }
+
+    response = lambda_handler.receive_handler(event, None)
+    assert response["batchItemFailures"] == [{"itemIdentifier": "r2"}]
+    assert count(aws, "mail") == 1
+    # only the stored email's claim is kept
+    assert count(aws, "dedup") == 1
+
+
+def test_invalid_item_does_not_fail_its_batch(aws, monkeypatch):
+    import lambda_handler
+    from lib.email import Email
+
+    as_dynamodb_item = Email.as_dynamodb_item
+
+    def blank_sender(email, *args, **kwargs):
+        item = as_dynamodb_item(email, *args, **kwargs)
+        if email.subject == "broken":
+            item["sender"] = {"S": ""}
+        return item
+
+    monkeypatch.setattr(Email, "as_dynamodb_item", blank_sender)
+    broken = (
+        b"From: Scam <scam@example.com>\r\nTo: Frank <frank56furter@gmail.com>\r\n"
+        b"Message-ID: <broken@example.com>\r\nSubject: broken\r\n\r\nhello\r\n"
+    )
+    event = {
+        "Records": [
+            record("r1", ses_event()),
+            record("r2", raw_event("m2", broken)),
+        ]
+    }
+
+    response = lambda_handler.receive_handler(event, None)
+    assert response["batchItemFailures"] == [{"itemIdentifier": "r2"}]
+    assert count(aws, "mail") == 1
+
+
+def queued(aws) -> list[dict]:
+    sqs = aws.aws_client("sqs")
+    url = sqs.get_queue_url(QueueName="client")["QueueUrl"]
+    messages = sqs.receive_message(QueueUrl=url, MaxNumberOfMessages=10)
+    return [json.loads(m["Body"]) for m in messages.get("Messages", [])]
+
+
+def test_message_delivered_to_two_personas_is_answered_once(aws):
+    import lambda_handler
+
+    first = ses_event()
+    second = ses_event()
+    second["mail"] = dict(second["mail"], destination=["other@example.com"])
+    # in one batch, and again in a later one
+    event = {"Records": [record("r1", first), record("r2", second)]}
+    assert lambda_handler.receive_handler(event, None)["batchItemFailures"] == []
+    event = {"Records": [record("r3", second)]}
+    assert lambda_handler.receive_handler(event, None)["batchItemFailures"] == []
+
+    [envelope] = queued(aws)
+    assert envelope["recipient"][1] == "frank56furter@gmail.com"
+    assert count(aws, "mail") == 1
+    assert count(aws, "dedup") == 1
+
+
+def test_bytes_codec_charset_is_stored(aws):
+    import lambda_handler
+
+    raw = (
+        b"From: Scammer <scammer@example.com>\r\n"
+        b"To: Frank <frank56furter@gmail.com>\r\n"
+        b"Message-ID: <charset@example.com>\r\n"
+        b"Subject: hello\r\n"
+        b"Content-Type: text/plain; charset=base64\r\n"
+        b"\r\n"
+        b"hello \xff there\r\n"
+    )
+    event = {"Records": [record("r1", raw_event("m1", raw))]}
+    assert lambda_handler.receive_handler(event, None)["batchItemFailures"] == []
+    assert count(aws, "mail") == 1
+
+
+def test_8bit_utf8_headers_are_stored_decoded(aws):
+    import lambda_handler
+
+    raw = (
+        "From: Jörg Müller <joerg@example.com>\r\n"
+        "To: Frank <frank56furter@gmail.com>\r\n"
+        "Message-ID: <utf8@example.com>\r\n"
+        "Subject: Grüße\r\n"
+        "\r\n"
+        "hello\r\n"
+    ).encode("utf-8")
+    event = {"Records": [record("r1", raw_event("m1", raw))]}
+    assert lambda_handler.receive_handler(event, None)["batchItemFailures"] == []
+
+    [item] = aws.aws_client("dynamodb").scan(TableName="mail")["Items"]
+    assert item["sender_name"]["S"] == "Jörg Müller"
+    assert item["subject"]["S"] == "Grüße"
+
+
+def test_from_without_an_address_uses_the_envelope_sender(aws):
+    import lambda_handler
+
+    raw = (
+        b"From: Undisclosed Sender\r\n"
+        b"To: Frank <frank56furter@gmail.com>\r\n"
+        b"Message-ID: <noaddress@example.com>\r\n"
+        b"Subject: hello\r\n"
+        b"\r\n"
+        b"hello\r\n"
+    )
+    ses_message = raw_event("m1", raw)
+    ses_message["mail"]["source"] = "bounce@example.com"
+    no_source = raw_event("m2", raw.replace(b"noaddress@", b"nosource@"))
+    del no_source["mail"]["source"]
+    event = {"Records": [record("r1", ses_message), record("r2", no_source)]}
+
+    response = lambda_handler.receive_handler(event, None)
+    assert response["batchItemFailures"] == [{"itemIdentifier": "r2"}]
+    [item] = aws.aws_client("dynamodb").scan(TableName="mail")["Items"]
+    assert item["sender"]["S"] == "bounce@example.com"
+    assert item["sender_name"]["S"] == "Undisclosed Sender"
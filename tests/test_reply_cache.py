@@ -0,0 +1,37 @@
+OPENER = (
+    "Dear friend, I am Barrister James Okafor and I have 4,500,000 USD "
+    "waiting for you. Reply to james@example.com to claim it."
+)
+
+
+def test_campaign_copies_share_a_fingerprint():
+    from lib.reply_cache import fingerprint
+
+    copy = OPENER.replace("4,500,000", "7,250,000").replace("james@", "jim@")
+    assert fingerprint(OPENER) == fingerprint(copy.upper())
+
+
+def test_short_or_empty_bodies_are_not_cached():
+    from lib.reply_cache import ReplyCache
+
+    cache = ReplyCache()
+    for body in ["", "   \n\n", "Did you get my mail?"]:
+        key = ReplyCache.key(body, "You are Frank Furter.", 0)
+        assert key is None
+        cache.put(key, "Hello there", 10.0)
+        assert cache.get(key) is None
+
+    assert cache.stats()["entries"] == 0
+    assert cache.stats()["misses"] == 0
+
+
+def test_reply_is_cached_per_personality():
+    from lib.reply_cache import ReplyCache
+
+    cache = ReplyCache(variation=False)
+    key = ReplyCache.key(OPENER, "You are Frank Furter.", 0)
+    cache.put(key, "Hello there", 10.0)
+
+    # another mailbox with the same personality shares the answer
+    assert cache.get(ReplyCache.key(OPENER, "You are Frank Furter.", 0)) == "Hello there"
+    assert cache.get(ReplyCache.key(OPENER, "You are Susan Smith.", 0)) is None
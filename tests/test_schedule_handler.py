@@ -0,0 +1,148 @@
+import json
+import time
+
+from botocore.exceptions import ClientError
+
+
+def schedule(aws, body: str = "later") -> str:
+    import lambda_handler
+    from lib.email import ClientReplyMessage, Email
+    from lib.headers import Contact
+
+    email = Email(
+        Contact("Frank", "frank56furter@gmail.com"),
+        Contact("Scammer", "scammer@example.com"),
+        "RE: hello",
+        body=body,
+    )
+    message = ClientReplyMessage(email=email, send_after=int(time.time()) - 5)
+    event = {"Records": [{"messageId": "s1", "body": message.as_json()}]}
+    assert lambda_handler.send_handler(event, None)["batchItemFailures"] == []
+    return email.get_message_id()
+
+
+def sent_states(aws) -> list[str]:
+    items = aws.aws_client("dynamodb").scan(TableName="mail")["Items"]
+    return [item["sent"]["S"] for item in items]
+
+
+def report(response: dict) -> dict:
+    return json.loads(response["body"])
+
+
+def test_failed_password_lookup_releases_the_claim(aws, monkeypatch):
+    import lambda_handler
+
+    schedule(aws)
+
+    def denied(name):
+        raise ClientError(
+            {"Error": {"Code": "AccessDeniedException", "Message": "denied"}},
+            "GetParameter",
+        )
+
+    sent = []
+    with monkeypatch.context() as patch:
+        patch.setattr(lambda_handler, "get_parameter", denied)
+        patch.setattr(lambda_handler.smtp_pool, "send", lambda *a: sent.append(a))
+        assert report(lambda_handler.schedule_handler({}, None))["failed"] == 1
+    assert sent_states(aws) == ["False"]
+
+    with monkeypatch.context() as patch:
+        patch.setattr(lambda_handler.smtp_pool, "send", lambda *a: sent.append(a))
+        assert report(lambda_handler.schedule_handler({}, None))["sent"] == 1
+    assert len(sent) == 1
+    assert sent_states(aws) == ["True"]
+
+
+def test_claim_error_fails_only_that_email(aws, monkeypatch):
+    import lambda_handler
+
+    schedule(aws, "first")
+    schedule(aws, "second")
+    claim_scheduled = lambda_handler.claim_scheduled
+    claims = []
+
+    def throttled(email, now):
+        claims.append(email)
+        if len(claims) == 1:
+            raise ClientError(
+                {"Error": {"Code": "ThrottlingException", "Message": "slow down"}},
+                "UpdateItem",
+            )
+        return claim_scheduled(email, now)
+
+    sent = []
+    monkeypatch.setattr(lambda_handler, "claim_scheduled", throttled)
+    monkeypatch.setattr(lambda_handler.smtp_pool, "send", lambda *a: sent.append(a))
+    result = report(lambda_handler.schedule_handler({}, None))
+    assert (result["failed"], result["sent"]) == (1, 1)
+    assert len(sent) == 1
+
+
+def test_stale_claim_is_taken_over(aws, monkeypatch):
+    import lambda_handler
+    from lib.email import Email
+
+    message_id = schedule(aws)
+    [item] = aws.aws_client("dynamodb").scan(TableName="mail")["Items"]
+    email = Email.from_dynamodb_item(item)
+
+    # claimed by a run that then died before sending or releasing it
+    now = int(time.time())
+    assert lambda_handler.claim_scheduled(email, now)
+    assert not lambda_handler.claim_scheduled(email, now)
+
+    sent = []
+    monkeypatch.setattr(lambda_handler.smtp_pool, "send", lambda *a: sent.append(a))
+    assert report(lambda_handler.schedule_handler({}, None))["backlog"] == 0
+    assert sent == []
+
+    monkeypatch.setattr(
+        lambda_handler.time,
+        "time",
+        lambda: now + lambda_handler.SEND_LEASE_SECONDS + 1,
+    )
+    assert report(lambda_handler.schedule_handler({}, None))["sent"] == 1
+    assert [message["Message-ID"] for _, _, message in sent] == [f"<{message_id}>"]
+
+
+def test_failed_mark_after_send_is_retried(aws, monkeypatch):
+    import lambda_handler
+
+    schedule(aws)
+    dynamodb = aws.aws_client("dynamodb")
+    marks = []
+
+    class Flaky:
+        def __getattr__(self, name):
+            return getattr(dynamodb, name)
+
+        def update_item(self, **kwargs):
+            if kwargs["UpdateExpression"].startswith("SET sent = :sent "):
+                marks.append(kwargs)
+                if len(marks) < lambda_handler.MARK_SENT_ATTEMPTS:
+                    raise RuntimeError("dynamodb unavailable")
+            return dynamodb.update_item(**kwargs)
+
+    sent = []
+    monkeypatch.setattr(
+        lambda_handler,
+        "aws_client",
+        lambda name: Flaky() if name == "dynamodb" else aws.aws_client(name),
+    )
+    monkeypatch.setattr(lambda_handler, "batch_backoff", lambda attempt: None)
+    monkeypatch.setattr(lambda_handler.smtp_pool, "send", lambda *a: sent.append(a))
+    assert report(lambda_handler.schedule_handler({}, None))["sent"] == 1
+    assert len(marks) == lambda_handler.MARK_SENT_ATTEMPTS
+    assert sent_states(aws) == ["True"]
+
+    # once the lease would have run out, nothing is left to take over
+    now = int(time.time())
+    monkeypatch.setattr(
+        lambda_handler.time,
+        "time",
+        lambda: now + lambda_handler.SEND_LEASE_SECONDS + 1,
+    )
+    report(lambda_handler.schedule_handler({}, None))
+    assert len(sent) == 1
@@ -0,0 +1,109 @@
+import threading
+from email.utils import parseaddr
+
+
+def reply(n: int, send_after: int = 0) -> dict:
+    from lib.email import ClientReplyMessage, Email
+    from lib.headers import Contact
+
+    email = Email(
+        Contact("Frank", "frank56furter@gmail.com"),
+        Contact("Scammer", f"scammer{n}@example.com"),
+        "RE: hello",
+        body=f"reply {n}",
+    )
+    message = ClientReplyMessage(email=email, send_after=send_after)
+    return {"messageId": f"r{n}", "body": message.as_json()}
+
+
+def failures(response: dict) -> list[str]:
+    return sorted(f["itemIdentifier"] for f in response["batchItemFailures"])
+
+
+def sent_states(aws) -> dict:
+    items = aws.aws_client("dynamodb").scan(TableName="mail")["Items"]
+    return {item["recipient"]["S"]: item["sent"]["S"] for item in items}
+
+
+def fake_smtp(monkeypatch, fail: set = frozenset()) -> list[str]:
+    import lambda_handler
+
+    sent = []
+
+    def send(sender, password, message):
+        recipient = parseaddr(message["To"])[1]
+        if recipient in fail:
+            raise ConnectionError("smtp unavailable")
+        sent.append(recipient)
+
+    monkeypatch.setattr(lambda_handler.smtp_pool, "send", send)
+    return sent
+
+
+def test_only_failed_records_are_reported(aws, monkeypatch):
+    import lambda_handler
+
+    sent = fake_smtp(monkeypatch, fail={"scammer1@example.com"})
+    event = {"Records": [reply(n) for n in range(4)]}
+
+    assert failures(lambda_handler.send_handler(event, None)) == ["r1"]
+    assert sorted(sent) == [f"scammer{n}@example.com" for n in (0, 2, 3)]
+    assert sent_states(aws) == {
+        f"scammer{n}@example.com": "True" for n in (0, 2, 3)
+    }
+
+
+def test_redelivered_batch_only_resends_what_failed(aws, monkeypatch):
+    import lambda_handler
+
+    event = {"Records": [reply(n) for n in range(4)]}
+    with monkeypatch.context() as patch:
+        fake_smtp(patch, fail={"scammer1@example.com"})
+        assert failures(lambda_handler.send_handler(event, None)) == ["r1"]
+
+    # the whole batch comes back, as it would from a handler that failed it all
+    sent = fake_smtp(monkeypatch)
+    assert failures(lambda_handler.send_handler(event, None)) == []
+    assert sent == ["scammer1@example.com"]
+
+
+def test_scheduled_reply_is_stored_unsent(aws, monkeypatch):
+    import lambda_handler
+
+    sent = fake_smtp(monkeypatch)
+    event = {"Records": [reply(0, send_after=2_000_000_000)]}
+
+    assert failures(lambda_handler.send_handler(event, None)) == []
+    assert sent == []
+    assert sent_states(aws) == {"scammer0@example.com": "False"}
+
+
+def test_redelivered_scheduled_reply_stays_sent(aws, monkeypatch):
+    import lambda_handler
+
+    sent = fake_smtp(monkeypatch)
+    event = {"Records": [reply(0, send_after=1)]}
+    assert failures(lambda_handler.send_handler(event, None)) == []
+    lambda_handler.schedule_handler({}, None)
+    assert sent_states(aws) == {"scammer0@example.com": "True"}
+
+    assert failures(lambda_handler.send_handler(event, None)) == []
+    lambda_handler.schedule_handler({}, None)
+    assert sent_states(aws) == {"scammer0@example.com": "True"}
+    assert sent == ["scammer0@example.com"]
+
+
+def test_records_are_sent_concurrently(aws, monkeypatch):
+    import lambda_handler
+
+    # every send waits for the others, which only returns if they overlap
+    barrier = threading.Barrier(lambda_handler.SEND_CONCURRENCY, timeout=10)
+    monkeypatch.setattr(
+        lambda_handler.smtp_pool, "send", lambda *args: barrier.wait()
+    )
+    event = {
+        "Records": [reply(n) for n in range(lambda_handler.SEND_CONCURRENCY)]
+    }
+
+    assert failures(lambda_handler.send_handler(event, None)) == []
+    assert not barrier.broken
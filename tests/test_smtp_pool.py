@@ -0,0 +1,127 @@
+import smtplib
+import socket
+from email.message import EmailMessage
+
+import pytest
+from aiosmtpd.controller import Controller
+
+
+class Inbox:
+    def __init__(self):
+        self.messages = []
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address.startswith("nobody@"):
+            return "550 no such user"
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(envelope.content)
+        return "250 OK"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class Server:
+    def __init__(self):
+        self.inbox = Inbox()
+        self.hostname = "127.0.0.1"
+        self.port = free_port()
+        self.start()
+
+    def start(self):
+        self.controller = Controller(self.inbox, hostname=self.hostname, port=self.port)
+        self.controller.start()
+
+    def stop(self):
+        self.controller.stop()
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+
+@pytest.fixture
+def server():
+    server = Server()
+    yield server
+    server.stop()
+
+
+def message(to: str = "scammer@example.com") -> EmailMessage:
+    email = EmailMessage()
+    email["From"] = "frank56furter@gmail.com"
+    email["To"] = to
+    email["Subject"] = "RE: hello"
+    email.set_content("Hello there")
+    return email
+
+
+def pool_for(server):
+    from lib.smtp_pool import SmtpPool
+
+    return SmtpPool(host=server.hostname, port=server.port, starttls=False)
+
+
+def test_session_is_reused(server):
+    pool = pool_for(server)
+    for _ in range(3):
+        pool.send("frank56furter@gmail.com", None, message())
+    pool.close()
+
+    assert len(server.inbox.messages) == 3
+    assert pool.connects == 1
+
+
+def test_refused_recipient_keeps_the_session(server):
+    pool = pool_for(server)
+    pool.send("frank56furter@gmail.com", None, message())
+    with pytest.raises(smtplib.SMTPRecipientsRefused):
+        pool.send("frank56furter@gmail.com", None, message("nobody@example.com"))
+    pool.send("frank56furter@gmail.com", None, message())
+    pool.close()
+
+    assert len(server.inbox.messages) == 2
+    assert pool.connects == 1
+
+
+def test_dropped_session_reconnects(server):
+    pool = pool_for(server)
+    pool.send("frank56furter@gmail.com", None, message())
+
+    # the server goes away and comes back, dropping the pooled connection
+    server.restart()
+
+    pool.send("frank56furter@gmail.com", None, message())
+    pool.close()
+
+    assert len(server.inbox.messages) == 2
+    assert pool.connects == 2
+
+
+def test_disconnect_while_sending_is_not_resent(server):
+    from lib.smtp_pool import SmtpSession
+
+    class Dropping:
+        def rset(self):
+            return 250, b"OK"
+
+        def send_message(self, message):
+            # as if the connection went while waiting for the reply to DATA
+            raise smtplib.SMTPServerDisconnected("connection unexpectedly closed")
+
+        def quit(self):
+            pass
+
+    pool = pool_for(server)
+    pool.checkin("frank56furter@gmail.com", SmtpSession(Dropping()))
+    with pytest.raises(smtplib.SMTPServerDisconnected):
+        pool.send("frank56furter@gmail.com", None, message())
+
+    assert server.inbox.messages == []
+    assert pool.connects == 0
@@ -0,0 +1,75 @@
+class Email:
+    # what ThreadCache needs of an email; thread() is the dynamodb query
+    def __init__(self, message_id: str, conversation: str = "c1", stored=()):
+        self.message_id = message_id
+        self.conversation = conversation
+        self.stored = list(stored)
+        self.loads = 0
+
+    def get_message_id(self) -> str:
+        return self.message_id
+
+    def conversation_id(self) -> str:
+        return self.conversation
+
+    def thread(self) -> list:
+        self.loads += 1
+        return list(self.stored)
+
+
+def ids(emails: list) -> list[str]:
+    return [email.get_message_id() for email in emails]
+
+
+def test_new_message_is_appended_to_a_cached_thread():
+    from lib.thread_cache import ThreadCache
+
+    cache = ThreadCache()
+    first = Email("m2", stored=[Email("m1")])
+    assert ids(cache.thread(first)) == ["m2", "m1"]
+
+    second = Email("m3")
+    assert ids(cache.thread(second)) == ["m3", "m2", "m1"]
+    assert second.loads == 0
+    assert (cache.hits, cache.misses, cache.size) == (1, 1, 3)
+
+    # a redelivered message isn't added twice
+    assert ids(cache.thread(Email("m3"))) == ["m3", "m2", "m1"]
+    assert cache.size == 3
+
+
+def test_stale_thread_is_reloaded(monkeypatch):
+    from lib import thread_cache
+    from lib.thread_cache import ThreadCache
+
+    cache = ThreadCache(stale_after=60)
+    cache.thread(Email("m1"))
+
+    later = thread_cache.time.time() + 61
+    monkeypatch.setattr(thread_cache.time, "time", lambda: later)
+    reloaded = Email("m3", stored=[Email("m2"), Email("m1")])
+    assert ids(cache.thread(reloaded)) == ["m3", "m2", "m1"]
+    assert reloaded.loads == 1
+    assert (cache.hits, cache.misses, cache.size) == (0, 2, 3)
+
+
+def test_eviction_keeps_size_accounting():
+    from lib.thread_cache import ThreadCache
+
+    cache = ThreadCache(max_conversations=2, max_emails=4)
+    cache.thread(Email("a2", "a", stored=[Email("a1", "a")]))
+    cache.thread(Email("b1", "b"))
+    cache.thread(Email("c1", "c"))
+    # three conversations, the oldest goes
+    assert list(cache.threads) == ["b", "c"]
+    assert cache.size == 2
+
+    cache.thread(Email("c3", "c", stored=[Email("c2", "c")]))
+    cache.thread(Email("c4", "c"))
+    cache.thread(Email("c5", "c"))
+    # over the email limit, whole conversations go oldest first
+    assert list(cache.threads) == ["c"]
+    assert cache.size == sum(len(t.emails) for t in cache.threads.values())
+
+    cache.invalidate("c")
+    assert (len(cache.threads), cache.size) == (0, 0)
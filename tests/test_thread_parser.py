@@ -0,0 +1,42 @@
+import json
+
+import pytest
+from conftest import data_path
+
+with open(data_path("threads.json")) as file:
+    SAMPLES = json.load(file)
+
+
+@pytest.mark.parametrize("sample", SAMPLES, ids=[sample["name"] for sample in SAMPLES])
+def test_strip_quoted(sample):
+    from lib.thread_parser import strip_quoted
+
+    assert strip_quoted(sample["body"]) == sample["expected"]
+
+
+def test_thread_turns_skip_the_excluded_and_empty_emails():
+    from lib.headers import Contact
+    from lib.thread_parser import Turn, thread_turns
+
+    class Email:
+        def __init__(self, message_id, sender, body, ts):
+            self.message_id = message_id
+            self.sender = sender
+            self.body = body
+            self.ts = ts
+
+        def get_message_id(self):
+            return self.message_id
+
+    frank = Contact("Frank", "frank56furter@gmail.com")
+    scammer = Contact("Scammer", "scammer@example.com")
+    # newest first, the way Email.thread() returns them
+    thread = [
+        Email("3", scammer, "Pay the fee.\n\nOn Mon, Frank wrote:\n> ok", 3),
+        Email("2", frank, "\n\n", 2),
+        Email("1", scammer, "Hello Frank, I have a deal for you.", 1),
+    ]
+
+    assert thread_turns(thread, exclude="3") == [
+        Turn(scammer, "Hello Frank, I have a deal for you.", 1)
+    ]